@@ -1,18 +1,30 @@
 
 import os
+import sys
+import time
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_login import LoginManager
 from dotenv import load_dotenv
+from app.ml.registry import ModelRegistry
+from app.cache import ForecastCache, UserCache
+from app.pipeline import PostIngestPipeline
+from app.metrics import Instrumentation, TimedQueuePool, record_startup
 
 load_dotenv()
 
 db = SQLAlchemy()
 login_manager = LoginManager()
 login_manager.login_view = 'views.login'
+model_registry = ModelRegistry()
+forecast_cache = ForecastCache()
+user_cache = UserCache()
+pipeline = PostIngestPipeline()
+instrumentation = Instrumentation()
 
 def create_app():
+    started, modules_before = time.perf_counter(), len(sys.modules)
     app = Flask(__name__)
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
     app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev-jwt-secret-key')
@@ -20,15 +32,67 @@ def create_app():
     if app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgres://"):
         app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace("postgres://", "postgresql://", 1)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = _engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 30)) # 0 = load the user from the DB on every request
+    app.config['USER_CACHE_MAX_ENTRIES'] = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 10000))
+    # Skip loading the model at start-up; the ML stack is imported on first use
+    app.config['FAST_START'] = os.environ.get('FAST_START', '0') == '1'
+    app.config['INGEST_CHUNK_SIZE'] = int(os.environ.get('INGEST_CHUNK_SIZE', 5000))
+    app.config['UPLOAD_SPOOL_DIR'] = os.environ.get('UPLOAD_SPOOL_DIR', os.path.join(app.instance_path, 'uploads'))
+    # Finished or abandoned streaming jobs (state, spooled CSV) are dropped after this long
+    app.config['UPLOAD_JOB_TTL_SECONDS'] = int(os.environ.get('UPLOAD_JOB_TTL_SECONDS', 86400))
+    app.config['MODEL_DIR'] = os.environ.get('MODEL_DIR', os.path.join(app.instance_path, 'models'))
+    app.config['MODEL_REFRESH_SECONDS'] = float(os.environ.get('MODEL_REFRESH_SECONDS', 30))
+    app.config['MODEL_KEEP_VERSIONS'] = int(os.environ.get('MODEL_KEEP_VERSIONS', 5))
+    app.config['MODEL_SHARDING'] = os.environ.get('MODEL_SHARDING', '0') == '1' # one model per department
+    app.config['MODEL_TRAIN_PROCESSES'] = int(os.environ.get('MODEL_TRAIN_PROCESSES', 0)) # 0 = all cores
+    app.config['MODEL_RETRAIN_MIN_ROWS'] = int(os.environ.get('MODEL_RETRAIN_MIN_ROWS', 200)) # live updates needed before a retrain
+    app.config['MODEL_N_JOBS'] = int(os.environ.get('MODEL_N_JOBS', -1)) # sklearn fit threads when unsharded, -1 = all cores
+    app.config['MODEL_COMPACT'] = os.environ.get('MODEL_COMPACT', '0') == '1' # serve a flattened NumPy forest (unsharded only)
+    app.config['MODEL_COMPACT_MAX_DEPTH'] = int(os.environ.get('MODEL_COMPACT_MAX_DEPTH', 0)) # 0 = keep every level
+    app.config['MODEL_COMPACT_MIN_SAMPLES'] = int(os.environ.get('MODEL_COMPACT_MIN_SAMPLES', 0)) # collapse splits with a smaller child
+    app.config['MODEL_COMPACT_FLOAT32'] = os.environ.get('MODEL_COMPACT_FLOAT32', '1') == '1'
+    app.config['FORECAST_CACHE_BACKEND'] = os.environ.get('FORECAST_CACHE_BACKEND', 'memory') # memory / sqlite
+    app.config['FORECAST_CACHE_PATH'] = os.environ.get('FORECAST_CACHE_PATH', os.path.join(app.instance_path, 'forecast_cache.db'))
+    app.config['FORECAST_CACHE_TTL'] = int(os.environ.get('FORECAST_CACHE_TTL', 3600))
+    app.config['FORECAST_CACHE_MAX_ENTRIES'] = int(os.environ.get('FORECAST_CACHE_MAX_ENTRIES', 256))
+    app.config['FORECAST_BASELINE_REFRESH_SECONDS'] = float(os.environ.get('FORECAST_BASELINE_REFRESH_SECONDS', 300))
+    app.config['PIPELINE_WORKERS'] = int(os.environ.get('PIPELINE_WORKERS', 1)) # 0 = run inline
+    app.config['PIPELINE_HISTORY'] = int(os.environ.get('PIPELINE_HISTORY', 50))
+    app.config['PIPELINE_RETRAIN_DELAY'] = float(os.environ.get('PIPELINE_RETRAIN_DELAY', 5))
+    app.config['RETENTION_RAW_DAYS'] = int(os.environ.get('RETENTION_RAW_DAYS', 90))
+    app.config['ARCHIVE_DIR'] = os.environ.get('ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+    app.config['ARCHIVE_FORMAT'] = os.environ.get('ARCHIVE_FORMAT', 'csv') # csv (gzip) / parquet
+    app.config['EVENTS_POLL_SECONDS'] = float(os.environ.get('EVENTS_POLL_SECONDS', 1))
+    app.config['EVENTS_HEARTBEAT_SECONDS'] = float(os.environ.get('EVENTS_HEARTBEAT_SECONDS', 15))
+    app.config['EVENTS_MAX_STREAM_SECONDS'] = float(os.environ.get('EVENTS_MAX_STREAM_SECONDS', 600))
+    # Each open stream holds a gunicorn thread; leave most of them for ordinary requests
+    app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get(
+        'EVENTS_MAX_STREAMS', max(int(os.environ.get('GUNICORN_THREADS', 32)) // 4, 1)))
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+    app.config['PROFILE_SLOW_REQUESTS_MS'] = float(os.environ.get('PROFILE_SLOW_REQUESTS_MS', 0)) # 0 = off
+    app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+    app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 50))
 
     db.init_app(app)
+    # Request timing, SQL counts, /metrics and slow-request profiles
+    instrumentation.init_app(app)
     login_manager.init_app(app)
+    user_cache.init_app(app)
+    # Loads the latest trained model artifact, if any, at worker startup
+    model_registry.init_app(app)
+    forecast_cache.init_app(app)
+    pipeline.init_app(app)
+
+    from app.ml.forecasting import forecaster
+    forecaster.init_app(app)
+    from app.events import event_broker
+    event_broker.init_app(app)
     CORS(app)
 
-    from app.models import User
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return user_cache.load(int(user_id))
 
     # Register Blueprints
     from app.routes.api import api_bp
@@ -37,4 +101,38 @@ def create_app():
     from app.routes.views import views_bp
     app.register_blueprint(views_bp)
 
+    record_startup(app, started, modules_before)
     return app
+
+
+def _engine_options(uri):
+    # Connections dropped by the server (idle timeouts, restarts) are
+    # replaced before use instead of failing the request
+    options = {'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1'}
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        # In-memory SQLite uses a single connection per thread, not a queue pool
+        return options
+    # Enough connections for every request thread of a gunicorn worker plus
+    # its background threads (pipeline lanes, event publisher, uploads)
+    pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+    connections = int(os.environ.get('GUNICORN_THREADS', 32)) + 4
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', max(connections - pool_size, 0))),
+        pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    )
+    return options
+
+
+def dispose_db_pools(app):
+    """Forgets pooled connections inherited from a parent process.
+
+    Called by gunicorn's post_fork hook when the app is preloaded in the
+    master, so every worker opens its own connections. The inherited ones
+    are left open for the parent (close=False).
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
@@ -0,0 +1,211 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class MemoryCacheBackend:
+    """Per-process LRU with expiry. Fastest, but not shared between workers."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            department, value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, department, value, ttl):
+        with self._lock:
+            self._entries[key] = (department, value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, department=None):
+        with self._lock:
+            if department is None:
+                self._entries.clear()
+                return
+            for key in [k for k, entry in self._entries.items() if entry[0] == department]:
+                del self._entries[key]
+
+
+class SQLiteCacheBackend:
+    """Cache in a local SQLite file, shared by every worker on the host."""
+
+    def __init__(self, path, max_entries=256):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS forecast_cache ('
+                'key TEXT PRIMARY KEY, department TEXT, value TEXT, expires_at REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_forecast_cache_department ON forecast_cache (department)')
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM forecast_cache WHERE key = ? AND expires_at >= ?', (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, department, value, ttl):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO forecast_cache (key, department, value, expires_at) VALUES (?, ?, ?, ?)',
+                (key, department, json.dumps(value), now + ttl)
+            )
+            conn.execute('DELETE FROM forecast_cache WHERE expires_at < ?', (now,))
+            # Entries are written once per key, so the oldest expiry is least recently computed
+            conn.execute(
+                'DELETE FROM forecast_cache WHERE key IN ('
+                'SELECT key FROM forecast_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+    def invalidate(self, department=None):
+        with self._connect() as conn:
+            if department is None:
+                conn.execute('DELETE FROM forecast_cache')
+            else:
+                conn.execute('DELETE FROM forecast_cache WHERE department = ?', (department,))
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+
+class ForecastCache:
+    """Caches forecasts per (department, model version, hour bucket).
+
+    Entries expire after ``FORECAST_CACHE_TTL`` seconds and are dropped
+    eagerly when new queue data arrives for their department. The backend is
+    chosen with ``FORECAST_CACHE_BACKEND`` (``memory`` or ``sqlite``); any
+    object with the same get/set/invalidate methods can be plugged in.
+    """
+
+    def __init__(self, app=None):
+        self.backend = MemoryCacheBackend()
+        self.ttl = 3600
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['FORECAST_CACHE_TTL']
+        max_entries = app.config['FORECAST_CACHE_MAX_ENTRIES']
+        if app.config['FORECAST_CACHE_BACKEND'] == 'sqlite':
+            self.backend = SQLiteCacheBackend(app.config['FORECAST_CACHE_PATH'], max_entries)
+        else:
+            self.backend = MemoryCacheBackend(max_entries)
+        app.extensions['forecast_cache'] = self
+
+    def get_or_compute(self, department, model_version, hours, compute):
+        """Returns the cached forecast, or calls compute(hour_start) and caches it."""
+        hour_start = datetime.now().replace(minute=0, second=0, microsecond=0)
+        key = f"{department}|{model_version}|{hour_start:%Y%m%d%H}|{hours}"
+        value = self.backend.get(key)
+        if value is None:
+            value = compute(hour_start)
+            self.backend.set(key, department, value, self.ttl)
+        return value
+
+    def invalidate(self, department=None):
+        """Drops cached forecasts for one department, or all of them."""
+        self.backend.invalidate(department)
+
+
+class UserCache:
+    """Short-lived per-process cache of the identity Flask-Login loads on every request.
+
+    Only ``id``, ``username`` and ``role`` are kept, and each request gets
+    its own transient User built from them, so nothing is shared between
+    threads or sessions and password hashes never sit in the cache. Entries
+    live ``USER_CACHE_TTL`` seconds (0 disables the cache); the least
+    recently used are dropped past ``USER_CACHE_MAX_ENTRIES``. Updating or
+    deleting a user through the ORM drops the entry in the process that made
+    the change; other workers see it once their entry expires, which is why
+    the TTL is short.
+    """
+
+    COLUMNS = ('id', 'username', 'role')
+
+    def __init__(self, app=None):
+        self.ttl = 30
+        self.max_entries = 10000
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['USER_CACHE_TTL']
+        self.max_entries = app.config['USER_CACHE_MAX_ENTRIES']
+        app.extensions['user_cache'] = self
+        from app.metrics import registry
+        registry.add_collector('user_cache', self.collect)
+
+    def load(self, user_id):
+        """The user with this id (None if there is none), from the cache when fresh."""
+        from app import db
+        from app.models import User
+        if self.ttl <= 0:
+            return db.session.get(User, user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] >= time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return User(**entry[0])
+            self.misses += 1
+
+        user = db.session.get(User, user_id)
+        if user is not None:
+            values = {c: getattr(user, c) for c in self.COLUMNS}
+            with self._lock:
+                self._entries[user_id] = (values, time.monotonic() + self.ttl)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id=None):
+        """Drops one user's entry, or all of them."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def collect(self):
+        # Exposition lines for /metrics
+        with self._lock:
+            hits, misses, size = self.hits, self.misses, len(self._entries)
+        return [
+            '# TYPE silentcare_user_cache_lookups_total counter',
+            f'silentcare_user_cache_lookups_total{{result="hit"}} {hits}',
+            f'silentcare_user_cache_lookups_total{{result="miss"}} {misses}',
+            '# TYPE silentcare_user_cache_entries gauge',
+            f'silentcare_user_cache_entries {size}',
+        ]
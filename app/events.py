@@ -0,0 +1,178 @@
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import func
+from app import db
+from app.models import OPDQueue, SilentIssue
+
+
+class EventBroker:
+    """Pushes new queue rows, alerts and forecast changes to SSE subscribers."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.poll_seconds = 1.0
+        self.max_subscribers = 8
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._active = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._last_queue_id = None
+        self._last_alert_id = None
+        self._last_forecasts = {}
+        self._forecast_state = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.poll_seconds = app.config['EVENTS_POLL_SECONDS']
+        self.max_subscribers = app.config['EVENTS_MAX_STREAMS']
+        app.extensions['event_broker'] = self
+
+    def subscribe(self, departments):
+        """Registers a client; None when this worker is at ``max_subscribers``."""
+        sub = Subscriber(departments)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(sub)
+            self._active.set()
+        self._ensure_publisher()
+        # Send the current forecasts straight away so the client can render
+        self._wakeup.set()
+        with self._lock:
+            for dept in sub.departments:
+                if dept in self._last_forecasts:
+                    sub.put('forecast', self._last_forecasts[dept])
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+            if not self._subscribers:
+                self._active.clear()
+
+    def notify(self):
+        """Hint that data changed locally, so the next check runs now."""
+        self._wakeup.set()
+
+    def _ensure_publisher(self):
+        # Threads don't survive a fork, so start one per worker process
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='event-publisher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            if not self._active.is_set():
+                # Re-baseline when the next client arrives instead of replaying history
+                with self._lock:
+                    self._last_queue_id = None
+                    self._last_forecasts = {}
+                self._active.wait()
+            self._wakeup.wait(timeout=self.poll_seconds)
+            self._wakeup.clear()
+            if not self._active.is_set():
+                continue
+            try:
+                with self.app.app_context():
+                    self._publish_changes()
+            except Exception:
+                self.app.logger.exception('Event publisher check failed')
+
+    def _publish_changes(self):
+        queue_id = db.session.query(func.max(OPDQueue.id)).scalar() or 0
+        alert_id = db.session.query(func.max(SilentIssue.id)).scalar() or 0
+        if self._last_queue_id is None:
+            # First run only sets the baseline
+            self._last_queue_id, self._last_alert_id = queue_id, alert_id
+
+        touched = set()
+        if queue_id > self._last_queue_id:
+            # Only the newest new row per department, however many arrived
+            latest_ids = db.session.query(func.max(OPDQueue.id)) \
+                .filter(OPDQueue.id > self._last_queue_id).group_by(OPDQueue.department)
+            rows = OPDQueue.query.filter(OPDQueue.id.in_(latest_ids)).all()
+            touched = {r.department for r in rows}
+            self._broadcast('queue', {'departments': [r.to_dict() for r in rows]})
+            self._last_queue_id = queue_id
+
+        if alert_id > self._last_alert_id:
+            for alert in SilentIssue.query.filter(SilentIssue.id > self._last_alert_id).order_by(SilentIssue.id):
+                self._broadcast('alert', alert.to_dict())
+            self._last_alert_id = alert_id
+
+        self._publish_forecasts(touched)
+
+    def _publish_forecasts(self, touched):
+        from app import forecast_cache, model_registry
+        from app.ml.forecasting import forecaster
+        hour = datetime.now().strftime('%Y%m%d%H')
+        state = (model_registry.version, hour)
+        with self._lock:
+            wanted = set().union(*(s.departments for s in self._subscribers))
+        stale = wanted if state != self._forecast_state else wanted & touched
+        stale |= wanted - set(self._last_forecasts)
+        self._forecast_state = state
+
+        predictor = model_registry.current()
+        for dept in sorted(stale):
+            if dept in touched:
+                # The write may have gone to another worker; drop our cached copy
+                forecast_cache.invalidate(dept)
+                forecaster.invalidate(dept)
+            forecast = forecast_cache.get_or_compute(
+                dept, model_registry.version, 12,
+                lambda hour_start: predictor.predict_future_slots(dept, hours=12, start=hour_start)
+            )
+            payload = {'department': dept, 'forecast': forecast}
+            # Only push forecasts that actually changed
+            if self._last_forecasts.get(dept) != payload:
+                self._last_forecasts[dept] = payload
+                self._broadcast('forecast', payload, department=dept)
+
+    def _broadcast(self, event, data, department=None):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            if department is None or department in sub.departments:
+                sub.put(event, data)
+
+
+class Subscriber:
+    """One connected client's bounded outbox."""
+
+    def __init__(self, departments, max_pending=100):
+        self.departments = set(departments)
+        self._queue = queue.Queue(maxsize=max_pending)
+
+    def put(self, event, data):
+        try:
+            self._queue.put_nowait((event, data))
+        except queue.Full:
+            # A stalled client drops events rather than holding memory
+            pass
+
+    def stream(self, heartbeat_seconds=15, max_seconds=600):
+        """Yields SSE frames; ends after max_seconds so the browser reconnects."""
+        yield 'retry: 3000\n\n'
+        deadline = time.monotonic() + max_seconds
+        while time.monotonic() < deadline:
+            try:
+                event, data = self._queue.get(timeout=heartbeat_seconds)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+event_broker = EventBroker()
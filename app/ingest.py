@@ -0,0 +1,402 @@
+import io
+import json
+import os
+import re
+import threading
+import uuid
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from app import db
+from app.models import OPDQueue, UploadJobProgress
+from app.rollups import apply_increments, apply_snapshot, rollup_increments, snapshot_rows
+from app.metrics import span, timed
+from sqlalchemy import select
+
+REQUIRED_COLUMNS = ['department', 'patients_waiting', 'active_doctors', 'avg_consultation_time']
+INSERT_COLUMNS = ['timestamp', 'department', 'patients_waiting', 'active_doctors', 'avg_consultation_time']
+COUNT_COLUMNS = ('patients_waiting', 'active_doctors')
+# Upper bounds that fit the columns (INTEGER is 32-bit on PostgreSQL)
+MAX_COUNT = 2**31 - 1
+MAX_CONSULTATION_MINUTES = 1e6
+
+# Cap on how many rejected rows are echoed back to the client
+MAX_REPORTED_REJECTS = 100
+
+# A running streaming job whose state hasn't been touched for this long is
+# assumed dead (e.g. its worker was recycled) and may be resumed elsewhere.
+STALE_JOB_SECONDS = 300
+JOB_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+class IngestError(Exception):
+    """A chunk failed to insert; the chunks before it stay committed."""
+
+    def __init__(self, message, chunks, committed_rows, resume_after_row):
+        super().__init__(message)
+        self.chunks = chunks
+        self.committed_rows = committed_rows
+        self.resume_after_row = resume_after_row
+
+    def to_dict(self):
+        return {
+            'error': str(self),
+            'committed_chunks': len(self.chunks),
+            'committed_rows': self.committed_rows,
+            'resume_after_row': self.resume_after_row,
+        }
+
+
+class _JobTakenOver(Exception):
+    # Another run of the same job committed past this run's position
+    pass
+
+
+class BulkQueueIngestor:
+    """Validates queue CSV data column-wise and inserts it in chunks."""
+
+    def __init__(self, chunk_size=5000):
+        self.chunk_size = max(int(chunk_size), 1)
+
+    def missing_columns(self, columns):
+        return [c for c in REQUIRED_COLUMNS if c not in columns]
+
+    @timed('ingest.prepare')
+    def prepare(self, df, row_offset=0):
+        """Coerces a raw CSV frame. Returns (clean_df, rejected_rows)."""
+        reasons = pd.Series('', index=df.index, dtype=object)
+
+        department = df['department'].astype('string').str.strip()
+        bad_dept = department.isna() | (department == '') | (department.str.len() > 50)
+        reasons[bad_dept.fillna(True).to_numpy(dtype=bool)] = 'invalid department'
+
+        numeric = {}
+        for col in ('patients_waiting', 'active_doctors', 'avg_consultation_time'):
+            values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float64)
+            # NaN and +-inf fail isfinite; counts must also be whole and fit the column
+            with np.errstate(invalid='ignore'):
+                bad = ~np.isfinite(values) | (values < 0)
+                if col in COUNT_COLUMNS:
+                    bad |= (values != np.floor(values)) | (values > MAX_COUNT)
+                else:
+                    bad |= values > MAX_CONSULTATION_MINUTES
+            reasons[bad & (reasons == '').to_numpy()] = f'invalid {col}'
+            numeric[col] = pd.Series(values, index=df.index)
+
+        # Unparseable or missing timestamps fall back to "now", as before
+        if 'timestamp' in df.columns:
+            ts = pd.to_datetime(df['timestamp'], errors='coerce', utc=True, format='ISO8601').dt.tz_localize(None)
+        else:
+            ts = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+        ts = ts.fillna(pd.Timestamp(datetime.utcnow()))
+
+        ok = (reasons == '').to_numpy()
+        clean = pd.DataFrame({
+            'timestamp': ts[ok],
+            'department': department[ok].astype(object),
+            'patients_waiting': numeric['patients_waiting'][ok].astype(np.int64),
+            'active_doctors': numeric['active_doctors'][ok].astype(np.int64),
+            'avg_consultation_time': numeric['avg_consultation_time'][ok].astype(np.float64),
+        })
+
+        rejected = [
+            # +2: one for the header line, one for 1-based numbering
+            {'row': int(pos) + row_offset + 2, 'reason': reasons.iat[pos]}
+            for pos in np.flatnonzero(~ok)
+        ]
+        return clean, rejected
+
+    def insert(self, clean, row_offset=0, before_commit=None):
+        """Inserts a prepared frame chunk by chunk, committing each chunk."""
+        chunks = []
+        for start in range(0, len(clean), self.chunk_size):
+            chunk = clean.iloc[start:start + self.chunk_size]
+            try:
+                with span('ingest.write'):
+                    self._write_chunk(chunk)
+                # Keep the hourly rollup and current-state snapshot in step, in the same transaction
+                with span('ingest.rollups'):
+                    apply_increments(rollup_increments(chunk))
+                    apply_snapshot(snapshot_rows(chunk))
+                # Whatever before_commit() writes commits together with the chunk
+                if before_commit is not None:
+                    before_commit()
+                with span('ingest.commit'):
+                    db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                committed = clean.iloc[:start]
+                raise IngestError(
+                    f'Chunk {len(chunks)} failed after {start} rows were committed: {e}', chunks, start,
+                    # +2 as in prepare(); None when nothing was committed
+                    int(committed.index[-1]) + row_offset + 2 if len(committed) else None
+                ) from e
+            chunks.append({'chunk': len(chunks), 'rows': len(chunk)})
+        return chunks
+
+    def ingest(self, df, row_offset=0):
+        clean, rejected = self.prepare(df, row_offset)
+        chunks = self.insert(clean, row_offset)
+        return {
+            'count': len(clean),
+            'departments': sorted(clean['department'].unique().tolist()),
+            'chunks': chunks,
+            'rejected': len(rejected),
+            'rejected_rows': rejected[:MAX_REPORTED_REJECTS],
+        }
+
+    def _write_chunk(self, chunk):
+        if db.engine.dialect.name == 'postgresql':
+            self._copy_chunk(chunk)
+            return
+        columns = [chunk[c].tolist() for c in INSERT_COLUMNS]
+        columns[0] = list(chunk['timestamp'].dt.to_pydatetime())
+        records = [dict(zip(INSERT_COLUMNS, values)) for values in zip(*columns)]
+        db.session.execute(OPDQueue.__table__.insert(), records)
+
+    def _copy_chunk(self, chunk):
+        # COPY is several times faster than executemany on PostgreSQL
+        buf = io.StringIO()
+        chunk[INSERT_COLUMNS].to_csv(buf, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S.%f')
+        buf.seek(0)
+        raw = db.session.connection().connection
+        with raw.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {OPDQueue.__tablename__} ({', '.join(INSERT_COLUMNS)}) FROM STDIN WITH CSV",
+                buf
+            )
+
+
+class StreamingUploadJobs:
+    """Runs large CSV imports in the background, resumable from the last committed chunk."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def start(self, app, file, on_complete=None):
+        spool_dir = self._spool_dir(app)
+        job_id = uuid.uuid4().hex
+        path = os.path.join(spool_dir, f'{job_id}.csv')
+        self._cleanup(app)
+        file.save(path)
+
+        try:
+            head = pd.read_csv(path, nrows=1)
+        except pd.errors.EmptyDataError:
+            os.remove(path)
+            raise ValueError('CSV file is empty')
+        missing = BulkQueueIngestor().missing_columns(head.columns)
+        if missing or not len(head):
+            os.remove(path)
+            raise ValueError(f'Missing columns. Required: {REQUIRED_COLUMNS}' if missing else 'CSV file has no data rows')
+
+        job = {
+            'id': job_id,
+            'status': 'queued',
+            'filename': file.filename,
+            'bytes_total': os.path.getsize(path),
+            'bytes_read': 0,
+            'progress': 0.0,
+            'rows_processed': 0,
+            'count': 0,
+            'rejected': 0,
+            'rejected_rows': [],
+            'chunks_committed': 0,
+            'error': None,
+            'created_at': datetime.utcnow().isoformat(),
+            'finished_at': None,
+        }
+        db.session.add(UploadJobProgress(id=job_id))
+        db.session.commit()
+        self._save(app, job)
+        self._launch(app, job_id, on_complete)
+        return dict(job)
+
+    def resume(self, app, job_id, on_complete=None):
+        job = self.get(app, job_id)
+        if job is None:
+            return None
+        with self._lock:
+            if job_id in self._running or job['status'] == 'completed':
+                return job
+        if job['status'] in ('queued', 'running') and not self._is_stale(job):
+            # Still owned by another worker that is making progress
+            return job
+        job['status'] = 'queued'
+        job['error'] = None
+        self._save(app, job)
+        self._launch(app, job_id, on_complete)
+        return job
+
+    def get(self, app, job_id):
+        if not JOB_ID_PATTERN.fullmatch(job_id or ''):
+            return None
+        with self._lock:
+            if job_id in self._running:
+                return dict(self._jobs[job_id])
+        # Jobs run by other workers (or before a restart) are read from disk
+        state_path = os.path.join(self._spool_dir(app), f'{job_id}.json')
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path) as f:
+            return json.load(f)
+
+    def _is_stale(self, job):
+        updated = datetime.fromisoformat(job['updated_at'])
+        return (datetime.utcnow() - updated).total_seconds() > STALE_JOB_SECONDS
+
+    def _launch(self, app, job_id, on_complete):
+        with self._lock:
+            self._running.add(job_id)
+        worker = threading.Thread(target=self._run, args=(app, job_id, on_complete), daemon=True)
+        worker.start()
+
+    def _run(self, app, job_id, on_complete):
+        with app.app_context():
+            job = self._jobs[job_id]
+            path = os.path.join(self._spool_dir(app), f'{job_id}.csv')
+            ingestor = BulkQueueIngestor(chunk_size=app.config['INGEST_CHUNK_SIZE'])
+            try:
+                # The database, not the state file, says what is committed
+                progress = db.session.get(UploadJobProgress, job_id)
+                if progress is None:
+                    progress = UploadJobProgress(id=job_id)
+                    db.session.add(progress)
+                    db.session.commit()
+                self._apply_progress(job, progress)
+                job['status'] = 'running'
+                self._save(app, job)
+                with open(path, 'rb') as fh:
+                    # Column names come from the header; resume after the last committed chunk
+                    header = fh.readline()
+                    position = max(progress.bytes_committed, len(header))
+                    fh.seek(position)
+                    for body, end in _read_records(fh, ingestor.chunk_size):
+                        chunk = pd.read_csv(io.BytesIO(header + body))
+                        clean, rejected = ingestor.prepare(chunk, row_offset=progress.rows_processed)
+
+                        def advance():
+                            # Lock the job row: a concurrent resume of this job
+                            # may already have committed this chunk
+                            db.session.execute(
+                                select(UploadJobProgress).where(UploadJobProgress.id == job_id)
+                                .with_for_update().execution_options(populate_existing=True)
+                            ).scalar_one()
+                            if max(progress.bytes_committed, len(header)) != position:
+                                raise _JobTakenOver()
+                            progress.bytes_committed = end
+                            progress.rows_processed += len(chunk)
+                            progress.count += len(clean)
+                            progress.rejected += len(rejected)
+                            progress.chunks_committed += 1
+
+                        if len(clean):
+                            ingestor.insert(clean, row_offset=progress.rows_processed, before_commit=advance)
+                        else:
+                            advance()
+                            db.session.commit()
+                        position = end
+                        self._apply_progress(job, progress)
+                        room = MAX_REPORTED_REJECTS - len(job['rejected_rows'])
+                        job['rejected_rows'].extend(rejected[:max(room, 0)])
+                        self._save(app, job)
+
+                job['status'] = 'completed'
+                job['progress'] = 1.0
+                job['bytes_read'] = job['bytes_total']
+                job['finished_at'] = datetime.utcnow().isoformat()
+                self._save(app, job)
+                os.remove(path)
+            except _JobTakenOver:
+                # The other run owns the job (and its state file) now
+                db.session.rollback()
+                return
+            except IngestError as e:
+                db.session.rollback()
+                if isinstance(e.__cause__, _JobTakenOver):
+                    return
+                job['status'] = 'failed'
+                job['error'] = str(e)
+                self._save(app, job)
+                return
+            except Exception as e:
+                db.session.rollback()
+                job['status'] = 'failed'
+                job['error'] = str(e)
+                self._save(app, job)
+                return
+            finally:
+                with self._lock:
+                    self._running.discard(job_id)
+                    self._jobs.pop(job_id, None)
+
+            # Rows are already committed, so a failure here doesn't fail the job
+            if on_complete is not None:
+                try:
+                    on_complete()
+                except Exception as e:
+                    app.logger.warning('Post-upload hook failed for job %s: %s', job_id, e)
+
+    def _cleanup(self, app):
+        # Drop jobs idle for longer than the TTL: state file, spooled CSV and progress row
+        spool_dir = self._spool_dir(app)
+        cutoff = datetime.utcnow().timestamp() - app.config['UPLOAD_JOB_TTL_SECONDS']
+        job_ids = {os.path.splitext(name)[0] for name in os.listdir(spool_dir)}
+        with self._lock:
+            job_ids = {j for j in job_ids if JOB_ID_PATTERN.fullmatch(j) and j not in self._running}
+        expired = []
+        for job_id in job_ids:
+            paths = [os.path.join(spool_dir, f'{job_id}{ext}') for ext in ('.json', '.csv')]
+            existing = [p for p in paths if os.path.exists(p)]
+            try:
+                # The state file is rewritten on every commit, so it dates the last activity
+                if existing and os.path.getmtime(existing[0]) < cutoff:
+                    for path in existing:
+                        os.remove(path)
+                    expired.append(job_id)
+            except OSError:
+                pass
+        if expired:
+            UploadJobProgress.query.filter(UploadJobProgress.id.in_(expired)).delete(synchronize_session=False)
+            db.session.commit()
+
+    def _apply_progress(self, job, progress):
+        for key in ('rows_processed', 'count', 'rejected', 'chunks_committed'):
+            job[key] = getattr(progress, key) or 0
+        job['bytes_read'] = progress.bytes_committed or 0
+        job['progress'] = round(job['bytes_read'] / max(job['bytes_total'], 1), 4)
+
+    def _save(self, app, job):
+        job['updated_at'] = datetime.utcnow().isoformat()
+        with self._lock:
+            self._jobs[job['id']] = job
+            snapshot = json.dumps(job)
+        state_path = os.path.join(self._spool_dir(app), f"{job['id']}.json")
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(snapshot)
+        os.replace(tmp_path, state_path)
+
+    def _spool_dir(self, app):
+        spool_dir = app.config['UPLOAD_SPOOL_DIR']
+        os.makedirs(spool_dir, exist_ok=True)
+        return spool_dir
+
+
+def _read_records(fh, size):
+    """Yields (raw bytes of up to `size` CSV records, file offset after them)."""
+    # A record continues over line breaks while it has an unclosed quote
+    lines, count, quoted = [], 0, False
+    for line in iter(fh.readline, b''):
+        lines.append(line)
+        if line.count(b'"') % 2:
+            quoted = not quoted
+        if not quoted:
+            count += 1
+            if count == size:
+                yield b''.join(lines), fh.tell()
+                lines, count = [], 0
+    if lines:
+        yield b''.join(lines), fh.tell()
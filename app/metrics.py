@@ -0,0 +1,310 @@
+import bisect
+import cProfile
+import functools
+import glob
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# Seconds; spans cover sub-millisecond predicts up to multi-minute training runs
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+# Imports that dominate worker start-up time and memory
+HEAVY_MODULES = ('numpy', 'pandas', 'sklearn', 'joblib', 'scipy')
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels, in Prometheus' shape."""
+
+    def __init__(self, name, help_text, label_names, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series['buckets'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted(self._series.items())
+            series = [(labels, dict(s, buckets=list(s['buckets']))) for labels, s in series]
+        for labels, s in series:
+            base = ['%s="%s"' % (k, _escape(v)) for k, v in zip(self.label_names, labels)]
+            cumulative = 0
+            for bound, n in zip(self.buckets, s['buckets']):
+                cumulative += n
+                lines.append('%s_bucket{%s} %d' % (self.name, ','.join(base + ['le="%s"' % bound]), cumulative))
+            lines.append('%s_bucket{%s} %d' % (self.name, ','.join(base + ['le="+Inf"']), s['count']))
+            suffix = '{%s}' % ','.join(base) if base else ''
+            lines.append(f'{self.name}_sum{suffix} {s["sum"]}')
+            lines.append(f'{self.name}_count{suffix} {s["count"]}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.request_seconds = Histogram(
+            'silentcare_request_seconds', 'Request handling time.', ('endpoint', 'method', 'status'))
+        self.request_sql_queries = Histogram(
+            'silentcare_request_sql_queries', 'SQL statements executed per request.', ('endpoint',), COUNT_BUCKETS)
+        self.request_sql_seconds = Histogram(
+            'silentcare_request_sql_seconds', 'Time spent in SQL statements per request.', ('endpoint',))
+        self.span_seconds = Histogram(
+            'silentcare_span_seconds', 'Time spent in named stages (training, prediction, ingest, ...).', ('span',))
+        self.db_pool_checkout_seconds = Histogram(
+            'silentcare_db_pool_checkout_seconds',
+            'Time to get a connection from the pool, including waiting for a free one or opening a new one.',
+            ('outcome',))
+        self._collectors = {}
+
+    def add_collector(self, name, func):
+        """Registers (or replaces) a function returning extra exposition lines (e.g. gauges)."""
+        self._collectors[name] = func
+
+    def render(self):
+        lines = []
+        for histogram in (self.request_seconds, self.request_sql_queries, self.request_sql_seconds, self.span_seconds,
+                          self.db_pool_checkout_seconds):
+            lines.extend(histogram.render())
+        for collect in list(self._collectors.values()):
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def span(name):
+    """Times a named stage into silentcare_span_seconds (and the current request's spans)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.span_seconds.observe(elapsed, name)
+        if has_request_context() and 'spans' in g:
+            g.spans.append((name, elapsed))
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records checkout time; outcome="timeout" counts pool exhaustion."""
+
+    def connect(self):
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            outcome = 'timeout'
+            raise
+        finally:
+            registry.db_pool_checkout_seconds.observe(time.perf_counter() - start, outcome)
+
+
+def record_startup(app, started, modules_before):
+    """Start-up report for create_app(): time taken, modules imported and whether the ML stack loaded."""
+    report = {
+        'create_app_seconds': round(time.perf_counter() - started, 4),
+        'modules_imported': len(sys.modules) - modules_before,
+        'modules_total': len(sys.modules),
+        'heavy_modules_loaded': [m for m in HEAVY_MODULES if m in sys.modules],
+        # ru_maxrss is in KiB on Linux
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'fast_start': app.config['FAST_START'],
+    }
+    app.extensions['startup'] = report
+    app.logger.info('create_app took %.0f ms, %d modules imported, heavy modules loaded: %s',
+                    report['create_app_seconds'] * 1000, report['modules_imported'],
+                    ', '.join(report['heavy_modules_loaded']) or 'none')
+
+    def collect():
+        lines = [
+            '# TYPE silentcare_startup_seconds gauge',
+            f"silentcare_startup_seconds {report['create_app_seconds']}",
+            '# TYPE silentcare_heavy_module_loaded gauge',
+        ]
+        # Evaluated at scrape time: shows when a lean worker pulled in the ML stack
+        lines.extend(f'silentcare_heavy_module_loaded{{module="{m}"}} {int(m in sys.modules)}' for m in HEAVY_MODULES)
+        return lines
+    registry.add_collector('startup', collect)
+    return report
+
+
+def timed(name):
+    """Decorator form of span()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Instrumentation:
+    """Per-request timing, SQL counting, /metrics and slow-request profiling.
+
+    Every request is timed by endpoint; SQL statements are counted (and
+    timed) through SQLAlchemy engine events; ``span()`` blocks inside the ML
+    and ingest code feed ``silentcare_span_seconds``. Connection-pool
+    occupancy is read at scrape time and checkout waits are recorded by
+    ``TimedQueuePool`` (the engines' pool class). Metrics live in the
+    process, so with several gunicorn workers each scrape sees one worker.
+
+    With ``PROFILE_SLOW_REQUESTS_MS`` > 0, requests run under cProfile (one
+    at a time per process; others just aren't profiled) and those slower
+    than the threshold are dumped to ``PROFILE_DIR`` for ``snakeviz`` or
+    ``python -m pstats``.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.profile_threshold = 0
+        self.profile_dir = None
+        self.profile_keep = 50
+        self._profile_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.profile_threshold = app.config['PROFILE_SLOW_REQUESTS_MS'] / 1000
+        self.profile_dir = app.config['PROFILE_DIR']
+        self.profile_keep = app.config['PROFILE_KEEP']
+        app.extensions['instrumentation'] = self
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        registry.add_collector('db_pool', self._collect_pools)
+
+        _listen_sql()
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(_before_render, app)
+        template_rendered.connect(_after_render, app)
+        app.add_url_rule('/metrics', 'metrics', lambda: Response(registry.render(), mimetype='text/plain; version=0.0.4'))
+
+    def _before_request(self):
+        g.request_start = time.perf_counter()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+        g.spans = []
+        if self.profile_threshold > 0 and self._profile_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    def _after_request(self, response):
+        if 'request_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or 'unmatched'
+        registry.request_seconds.observe(elapsed, endpoint, request.method, str(response.status_code))
+        registry.request_sql_queries.observe(g.sql_queries, endpoint)
+        registry.request_sql_seconds.observe(g.sql_seconds, endpoint)
+        response.headers['Server-Timing'] = ', '.join(
+            [f'app;dur={elapsed * 1000:.1f}', f'sql;dur={g.sql_seconds * 1000:.1f};desc="{g.sql_queries} queries"']
+        )
+
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            self._profile_lock.release()
+            if elapsed >= self.profile_threshold:
+                self._dump_profile(profiler, endpoint, elapsed)
+        return response
+
+    def _teardown_request(self, exc):
+        # after_request is skipped when the view raised
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            self._profile_lock.release()
+
+    def _collect_pools(self):
+        from app import db
+        lines = ['# TYPE silentcare_db_pool_connections gauge']
+        with self.app.app_context():
+            engines = dict(db.engines)
+        for bind, engine in sorted(engines.items(), key=lambda item: str(item[0])):
+            pool = engine.pool
+            if not isinstance(pool, QueuePool):
+                continue
+            # Overflow is negative while the pool has not opened pool_size connections yet
+            for state, value in (('size', pool.size()), ('checked_out', pool.checkedout()),
+                                 ('idle', pool.checkedin()), ('overflow', max(pool.overflow(), 0))):
+                lines.append(f'silentcare_db_pool_connections{{bind="{_escape(bind or "default")}",state="{state}"}} {value}')
+        return lines
+
+    def _dump_profile(self, profiler, endpoint, elapsed):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{endpoint.replace('.', '_')}-{elapsed * 1000:.0f}ms.prof"
+        profiler.dump_stats(os.path.join(self.profile_dir, name))
+        self.app.logger.warning(
+            'Slow request %s %s: %.0f ms, %d SQL queries, spans %s; profile saved as %s',
+            request.method, request.path, elapsed * 1000, g.sql_queries,
+            ', '.join(f'{n}={s * 1000:.1f}ms' for n, s in g.spans), name
+        )
+        for path in sorted(glob.glob(os.path.join(self.profile_dir, '*.prof')), key=os.path.getmtime)[:-self.profile_keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_sql_listening = False
+
+
+def _listen_sql():
+    # Engine-class listeners see every engine, so this runs once per process
+    global _sql_listening
+    if _sql_listening:
+        return
+    _sql_listening = True
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start'] = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'sql_queries' in g:
+            g.sql_queries += 1
+            g.sql_seconds += time.perf_counter() - conn.info.get('query_start', time.perf_counter())
+
+
+def _before_render(sender, template, context, **extra):
+    if 'spans' in g:
+        g.render_start = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    start = g.pop('render_start', None)
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        registry.span_seconds.observe(elapsed, f'render:{template.name}')
+        g.spans.append((f'render:{template.name}', elapsed))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
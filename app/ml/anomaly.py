@@ -1,66 +1,231 @@
-import numpy as np
-import pandas as pd
-from app.models import OPDQueue, SilentIssue
+import math
+import threading
+from collections import deque
+from sqlalchemy import false, func, select
+from app.models import OPDQueue, OPDQueueCurrent, SilentIssue
+from app.metrics import timed
 from app import db
-from datetime import datetime, timedelta
+from datetime import datetime
 
-class SilentIssueDetector:
-    def analyze_recent_data(self):
-        # 1. Fetch recent records
-        records = OPDQueue.query.order_by(OPDQueue.timestamp.desc()).limit(50).all()
-        if len(records) < 10:
+WINDOW_COLUMNS = ['id', 'department', 'patients_waiting', 'active_doctors']
+
+
+class AlertDedupWindow:
+    """When each (issue type, department) last raised an alert, per process.
+
+    A hit inside the window suppresses the alert without a query; a miss
+    falls back to one indexed lookup, so alerts raised by other workers are
+    still seen.
+    """
+
+    def __init__(self, seconds=3600):
+        self.seconds = seconds
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def is_recent(self, issue_type, department, now):
+        key = (issue_type, department)
+        with self._lock:
+            last = self._last.get(key)
+        if last is not None and (now - last).total_seconds() < self.seconds:
+            return True
+        last = db.session.query(func.max(SilentIssue.timestamp)).filter(
+            SilentIssue.issue_type == issue_type,
+            SilentIssue.department.is_(None) if department is None else SilentIssue.department == department,
+            # "= false" (not "IS false") so PostgreSQL can use the index
+            SilentIssue.is_resolved == false()
+        ).scalar()
+        if last is None:
+            return False
+        self.record(issue_type, department, last)
+        return (now - last).total_seconds() < self.seconds
+
+    def record(self, issue_type, department, timestamp):
+        with self._lock:
+            previous = self._last.get((issue_type, department))
+            if previous is None or timestamp > previous:
+                self._last[(issue_type, department)] = timestamp
+
+
+alert_window = AlertDedupWindow()
+
+
+class DepartmentWindow:
+    """Last `size` patient counts of one department with running sums."""
+    __slots__ = ('values', 'total', 'total_sq', 'latest_doctors')
+
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self.total = 0
+        self.total_sq = 0
+        self.latest_doctors = 0
+
+    def push(self, patients_waiting, active_doctors):
+        if len(self.values) == self.values.maxlen:
+            oldest = self.values[0]
+            self.total -= oldest
+            self.total_sq -= oldest * oldest
+        self.values.append(patients_waiting)
+        self.total += patients_waiting
+        self.total_sq += patients_waiting * patients_waiting
+        self.latest_doctors = active_doctors
+
+    def mean(self):
+        return self.total / len(self.values)
+
+    def std(self):
+        # Sample std (ddof=1), matching pandas; counts are ints so the sums are exact
+        n = len(self.values)
+        if n < 2:
+            return 0.0
+        return math.sqrt(max(self.total_sq - self.total * self.total / n, 0) / (n - 1))
+
+
+class StreamingIssueDetector:
+    """Evaluates the silent-issue rules per department in O(1) per record.
+
+    Each department keeps a ring buffer of its last WINDOW patient counts
+    with running sum / sum of squares, so the z-score and growth checks need
+    no query. State is loaded from the database on first use; sync() then
+    folds in rows committed since, by any worker, with one id range query.
+    """
+    WINDOW = 50
+    MIN_RECORDS = 10
+    SURGE_Z = 2.5
+    SHORTAGE_MAX_DOCTORS = 2
+    SHORTAGE_MIN_PATIENTS = 15
+    GROWTH_LAG = 2
+    GROWTH_MIN = 10
+    GROWTH_MIN_PATIENTS = 20
+
+    def __init__(self):
+        self._windows = {}
+        self._last_id = None
+        self._lock = threading.Lock()
+
+    @timed('analyze')
+    def analyze_recent_data(self, departments=None):
+        # Full resync (e.g. after a bulk upload), then check the given departments
+        self.rebuild()
+        departments = list(self._windows) if departments is None else departments
+        for department in departments:
+            self.evaluate(department)
+        return departments
+
+    @timed('analyze.sync')
+    def sync(self):
+        """Folds in every row committed since the last one seen and evaluates
+        the departments they belong to. Used by the background pipeline, where
+        many updates are coalesced into one run."""
+        with self._lock:
+            if self._last_id is None:
+                self._load()
+                touched = set(self._windows)
+            else:
+                touched = self._catch_up()
+        for department in sorted(touched):
+            self.evaluate(department)
+        return touched
+
+    def rebuild(self):
+        with self._lock:
+            self._load()
+
+    def evaluate(self, department):
+        window = self._windows.get(department)
+        if window is None or len(window.values) < self.MIN_RECORDS:
             return
-            
-        data = [r.to_dict() for r in records]
-        df = pd.DataFrame(data)
-        
-        latest = df.iloc[0]
-        
+        values = window.values
+        latest = values[-1]
+
         # --- Type 1: Sudden Crowd Surge (Z-Score) ---
-        mean_patients = df['patients_waiting'].mean()
-        std_patients = df['patients_waiting'].std()
-        
+        mean_patients = window.mean()
+        std_patients = window.std()
         if std_patients > 0:
-            z_score = (latest['patients_waiting'] - mean_patients) / std_patients
-            if z_score > 2.5: 
+            z_score = (latest - mean_patients) / std_patients
+            if z_score > self.SURGE_Z:
                 self._create_alert(
-                    "Sudden Crowd Surge", 
-                    "High", 
-                    f"Patient count {latest['patients_waiting']} is significantly higher than usual ({mean_patients:.1f})."
+                    "Sudden Crowd Surge",
+                    "High",
+                    f"Patient count {latest} in {department} is significantly higher than usual ({mean_patients:.1f}).",
+                    department
                 )
 
         # --- Type 2: Efficiency Drop ---
-        # High patients but active doctors < 2
-        if latest['active_doctors'] < 2 and latest['patients_waiting'] > 15:
-             self._create_alert(
-                    "Severe Staff Shortage", 
-                    "High", 
-                    f"Critical: {latest['patients_waiting']} patients waiting with only {latest['active_doctors']} doctor(s)."
-                )
+        if window.latest_doctors < self.SHORTAGE_MAX_DOCTORS and latest > self.SHORTAGE_MIN_PATIENTS:
+            self._create_alert(
+                "Severe Staff Shortage",
+                "High",
+                f"Critical: {latest} patients waiting in {department} with only {window.latest_doctors} doctor(s).",
+                department
+            )
 
         # --- Type 3: Trend Deviation (Growth Rate) ---
-        # Check if queue grown by > 50% in last 3 records
-        if len(df) >= 3:
-            recent_growth = df.iloc[0]['patients_waiting'] - df.iloc[2]['patients_waiting']
-            if recent_growth > 10 and latest['patients_waiting'] > 20:
-                 self._create_alert(
-                    "Rapid Queue Growth", 
-                    "Medium", 
-                    f"Queue grew by {recent_growth} patients in short interval."
+        if len(values) > self.GROWTH_LAG:
+            recent_growth = latest - values[-1 - self.GROWTH_LAG]
+            if recent_growth > self.GROWTH_MIN and latest > self.GROWTH_MIN_PATIENTS:
+                self._create_alert(
+                    "Rapid Queue Growth",
+                    "Medium",
+                    f"{department} queue grew by {recent_growth} patients in short interval.",
+                    department
                 )
 
-    def _create_alert(self, type, severity, desc):
-        # Check if similar alert exists recently (deduplication)
-        recent = SilentIssue.query.filter_by(issue_type=type, is_resolved=False).order_by(SilentIssue.timestamp.desc()).first()
-        if recent:
-            # If recent alert is less than 1 hour old, skip
-            if (datetime.utcnow() - recent.timestamp).total_seconds() < 3600:
-                return
+    def _create_alert(self, type, severity, desc, department):
+        # Skip if the same kind of alert was raised for this department in the last hour (deduplication)
+        now = datetime.utcnow()
+        if alert_window.is_recent(type, department, now):
+            return
 
         alert = SilentIssue(
+            timestamp=now,
             issue_type=type,
+            department=department,
             severity=severity,
             description=desc
         )
         db.session.add(alert)
         db.session.commit()
+        alert_window.record(type, department, now)
+
+    def _push(self, department, patients_waiting, active_doctors):
+        window = self._windows.get(department)
+        if window is None:
+            window = self._windows[department] = DepartmentWindow(self.WINDOW)
+        window.push(patients_waiting, active_doctors)
+
+    def _load(self):
+        # Rows after this id are left to _catch_up
+        last_id = db.session.query(func.max(OPDQueue.id)).scalar() or 0
+        self._windows = {}
+        for department in self._departments():
+            # Last WINDOW rows of the department, read backwards along
+            # ix_sc_opd_queue_department_timestamp instead of ranking the table
+            rows = db.session.execute(
+                select(OPDQueue.patients_waiting, OPDQueue.active_doctors)
+                .where(OPDQueue.department == department, OPDQueue.id <= last_id)
+                .order_by(OPDQueue.timestamp.desc(), OPDQueue.id.desc())
+                .limit(self.WINDOW)
+            ).all()
+            for patients_waiting, active_doctors in reversed(rows):
+                self._push(department, patients_waiting, active_doctors)
+        self._last_id = last_id
+
+    def _departments(self):
+        # The latest-state snapshot has one row per department; scan the
+        # index only if it is empty (e.g. before rebuild_rollups.py has run)
+        departments = db.session.scalars(select(OPDQueueCurrent.department)).all()
+        if not departments:
+            departments = db.session.scalars(select(OPDQueue.department).distinct()).all()
+        return sorted(departments)
+
+    def _catch_up(self):
+        from app.ml.features import QueueFeatureLoader
+        touched = set()
+        for chunk in QueueFeatureLoader().iter_chunks(WINDOW_COLUMNS, min_id=self._last_id):
+            for row_id, department, patients_waiting, active_doctors in zip(
+                    *(chunk[c].tolist() for c in WINDOW_COLUMNS)):
+                self._push(department, patients_waiting, active_doctors)
+                self._last_id = row_id
+                touched.add(department)
+        return touched
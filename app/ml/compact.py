@@ -0,0 +1,182 @@
+import time
+import numpy as np
+
+# sklearn.tree._tree.TREE_LEAF, without importing scikit-learn
+TREE_LEAF = -1
+
+
+class CompactForest:
+    """A fitted random forest flattened into a handful of NumPy arrays.
+
+    Every tree's nodes are concatenated into ``feature``, ``threshold``,
+    ``left``, ``right`` and ``value``; ``roots`` holds the index of each
+    tree's root. Leaves point at themselves, so ``predict`` walks all trees
+    for all rows at once, one vectorised step per level, and needs neither
+    scikit-learn nor per-tree Python calls.
+
+    ``from_forest`` can prune while exporting: ``max_depth`` turns the nodes
+    at that depth into leaves, ``min_samples`` collapses splits with a child
+    of fewer training samples. A collapsed node predicts the mean of its
+    training samples, which sklearn already stores for every node. With
+    ``float32`` thresholds and values take half the space; thresholds are
+    rounded down so every row still takes the same branch as in sklearn.
+    """
+
+    def __init__(self, feature, threshold, left, right, value, roots, depth):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        self.options = {}
+
+    @classmethod
+    def from_forest(cls, model, max_depth=None, min_samples=None, float32=True):
+        dtype = np.float32 if float32 else np.float64
+        parts = []
+        offset = 0
+        depth = 0
+        for estimator in model.estimators_:
+            tree = _flatten_tree(estimator.tree_, max_depth, min_samples)
+            # Node indices are local to the tree until shifted by its offset
+            tree['left'] += offset
+            tree['right'] += offset
+            parts.append(tree)
+            offset += len(tree['value'])
+            depth = max(depth, tree['depth'])
+
+        threshold = np.concatenate([p['threshold'] for p in parts])
+        if float32:
+            # sklearn compares float32 features with float64 thresholds;
+            # rounding down keeps "x <= threshold" exact for float32 x
+            rounded = threshold.astype(np.float32)
+            too_high = rounded.astype(np.float64) > threshold
+            rounded[too_high] = np.nextafter(rounded[too_high], np.float32(-np.inf))
+            threshold = rounded
+        forest = cls(
+            feature=np.concatenate([p['feature'] for p in parts]).astype(np.int16),
+            threshold=threshold,
+            left=np.concatenate([p['left'] for p in parts]).astype(np.int32),
+            right=np.concatenate([p['right'] for p in parts]).astype(np.int32),
+            value=np.concatenate([p['value'] for p in parts]).astype(dtype),
+            roots=np.cumsum([0] + [len(p['value']) for p in parts[:-1]]).astype(np.int32),
+            depth=depth,
+        )
+        forest.options = {'max_depth': max_depth, 'min_samples': min_samples, 'float32': float32}
+        return forest
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.value)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.feature, self.threshold, self.left, self.right, self.value, self.roots))
+
+    def predict(self, X):
+        # Same input precision as sklearn's trees
+        X = np.asarray(X, dtype=np.float32)
+        n_rows, n_features = X.shape
+        flat = X.ravel()
+        # Start of each (tree, row) pair's feature row in the flattened matrix
+        offsets = np.tile(np.arange(n_rows) * n_features, self.n_trees)
+        nodes = np.repeat(self.roots, n_rows)
+        # Pairs still descending; a pair stops once it reaches a leaf, which
+        # is the only node that points at itself
+        active = np.arange(len(nodes))
+        for _ in range(self.depth):
+            current = nodes[active]
+            go_left = flat[offsets[active] + self.feature[current]] <= self.threshold[current]
+            following = np.where(go_left, self.left[current], self.right[current])
+            nodes[active] = following
+            active = active[following != current]
+            if not len(active):
+                break
+        # Forest prediction is the plain mean over trees
+        return self.value[nodes].reshape(self.n_trees, n_rows).mean(axis=0, dtype=np.float64)
+
+
+def _flatten_tree(tree, max_depth, min_samples):
+    left, right = tree.children_left, tree.children_right
+    counts = tree.n_node_samples
+    # Breadth-first over the levels that survive pruning
+    kept, leaf = [], []
+    frontier = np.array([0])
+    level = 0
+    while len(frontier):
+        is_leaf = left[frontier] == TREE_LEAF
+        if max_depth is not None and level >= max_depth:
+            is_leaf[:] = True
+        if min_samples:
+            internal = ~is_leaf
+            small = np.zeros(len(frontier), dtype=bool)
+            small[internal] = np.minimum(counts[left[frontier[internal]]],
+                                         counts[right[frontier[internal]]]) < min_samples
+            is_leaf |= small
+        kept.append(frontier)
+        leaf.append(is_leaf)
+        splits = frontier[~is_leaf]
+        frontier = np.concatenate([left[splits], right[splits]])
+        level += 1
+
+    kept, leaf = np.concatenate(kept), np.concatenate(leaf)
+    index = np.full(tree.node_count, -1, dtype=np.int64)
+    index[kept] = np.arange(len(kept))
+    own = np.arange(len(kept))
+    return {
+        'feature': np.where(leaf, 0, tree.feature[kept]),
+        'threshold': np.where(leaf, np.inf, tree.threshold[kept]),
+        # Leaves loop back to themselves
+        'left': np.where(leaf, own, index[np.where(leaf, 0, left[kept])]),
+        'right': np.where(leaf, own, index[np.where(leaf, 0, right[kept])]),
+        'value': tree.value[kept, 0, 0],
+        'depth': level - 1,
+    }
+
+
+def compare(model, forest, X, repeats=20):
+    """Accuracy, size and latency of a CompactForest against the sklearn forest it came from."""
+    X = np.asarray(X, dtype=np.float64)
+    expected = model.predict(X)
+    actual = forest.predict(X)
+    errors = np.abs(actual - expected)
+
+    def best_of(func, *args):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            func(*args)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    row = X[:1]
+    sklearn_row, compact_row = best_of(model.predict, row), best_of(forest.predict, row)
+    sklearn_batch, compact_batch = best_of(model.predict, X), best_of(forest.predict, X)
+    sklearn_nodes = sum(e.tree_.node_count for e in model.estimators_)
+    sklearn_bytes = sum(
+        sum(getattr(e.tree_, a).nbytes for a in ('children_left', 'children_right', 'feature', 'threshold',
+                                                 'value', 'impurity', 'n_node_samples', 'weighted_n_node_samples'))
+        for e in model.estimators_
+    )
+    return {
+        'options': forest.options,
+        'rows': len(X),
+        'mean_abs_error': round(float(errors.mean()), 6),
+        'max_abs_error': round(float(errors.max()), 6),
+        'rmse': round(float(np.sqrt((errors ** 2).mean())), 6),
+        'nodes': forest.n_nodes,
+        'sklearn_nodes': sklearn_nodes,
+        'depth': forest.depth,
+        'bytes': forest.nbytes,
+        'sklearn_bytes': sklearn_bytes,
+        'row_ms': round(compact_row * 1000, 4),
+        'sklearn_row_ms': round(sklearn_row * 1000, 4),
+        'batch_ms': round(compact_batch * 1000, 4),
+        'sklearn_batch_ms': round(sklearn_batch * 1000, 4),
+    }
@@ -0,0 +1,114 @@
+import time
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from sqlalchemy import extract, select
+from app import db
+from app.models import OPDQueue
+
+FEATURE_COLUMNS = ['patients_waiting', 'active_doctors', 'hour', 'day_of_week']
+RAW_COLUMNS = ['id', 'timestamp', 'department', 'patients_waiting', 'active_doctors', 'avg_consultation_time']
+
+
+class QueueFeatureLoader:
+    """Reads sc_opd_queue column-wise, in chunks, without ORM objects.
+
+    Only the requested columns are selected with a Core query and streamed
+    through ``pd.read_sql(chunksize=...)``; hour, weekday and the wait-time
+    target are derived with NumPy on whole columns. With ``derive_in_sql``
+    the database computes hour and weekday instead.
+    """
+
+    def __init__(self, chunk_size=50000, derive_in_sql=False):
+        self.chunk_size = chunk_size
+        self.derive_in_sql = derive_in_sql
+        self.stats = {}
+
+    def iter_chunks(self, columns=RAW_COLUMNS, min_id=None, max_id=None, department=None,
+                    newest_first=False, limit=None):
+        """Yields DataFrames of the selected columns (names or SQL expressions), ordered by id."""
+        query = select(*(getattr(OPDQueue, c) if isinstance(c, str) else c for c in columns))
+        if min_id is not None:
+            query = query.where(OPDQueue.id > min_id)
+        if max_id is not None:
+            query = query.where(OPDQueue.id <= max_id)
+        if department is not None:
+            query = query.where(OPDQueue.department == department)
+        query = query.order_by(OPDQueue.id.desc() if newest_first else OPDQueue.id)
+        if limit is not None:
+            query = query.limit(limit)
+        yield from pd.read_sql(query, db.session.connection(), chunksize=self.chunk_size)
+
+    def training_data(self, min_id=None, max_id=None, department=None, newest_first=False, limit=None):
+        """Returns (X, y, meta) for the matching rows; X is float64 in FEATURE_COLUMNS order.
+
+        meta holds the row count and the highest id / timestamp seen, which
+        is what the predictor's training watermark needs.
+        """
+        start = time.perf_counter()
+        if self.derive_in_sql:
+            columns = [
+                OPDQueue.id, OPDQueue.timestamp, OPDQueue.patients_waiting, OPDQueue.active_doctors,
+                OPDQueue.avg_consultation_time,
+                extract('hour', OPDQueue.timestamp).label('hour'),
+                # dow is 0=Sunday on both SQLite and PostgreSQL; shift to 0=Monday
+                ((extract('dow', OPDQueue.timestamp) + 6) % 7).label('day_of_week'),
+            ]
+        else:
+            columns = ['id', 'timestamp', 'patients_waiting', 'active_doctors', 'avg_consultation_time']
+        chunks = self.iter_chunks(columns, min_id, max_id, department, newest_first, limit)
+
+        xs, ys = [], []
+        meta = {'rows': 0, 'max_id': None, 'max_timestamp': None}
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            x, y = feature_matrix(chunk)
+            xs.append(x)
+            ys.append(y)
+            meta['rows'] += len(chunk)
+            chunk_max_id = int(chunk['id'].max())
+            chunk_max_ts = pd.Timestamp(chunk['timestamp'].max()).to_pydatetime()
+            if meta['max_id'] is None or chunk_max_id > meta['max_id']:
+                meta['max_id'] = chunk_max_id
+            if meta['max_timestamp'] is None or chunk_max_ts > meta['max_timestamp']:
+                meta['max_timestamp'] = chunk_max_ts
+
+        if xs:
+            X, y = np.concatenate(xs), np.concatenate(ys)
+        else:
+            X, y = np.empty((0, len(FEATURE_COLUMNS))), np.empty(0)
+        self.stats = {
+            'rows': meta['rows'],
+            'load_seconds': round(time.perf_counter() - start, 4),
+            'bytes': int(X.nbytes + y.nbytes),
+        }
+        return X, y, meta
+
+
+def feature_matrix(chunk):
+    """(X, y) from a frame of raw queue columns, all NumPy, no per-row Python."""
+    patients = chunk['patients_waiting'].to_numpy(dtype=np.float64)
+    doctors = chunk['active_doctors'].to_numpy(dtype=np.float64)
+    consultation = chunk['avg_consultation_time'].to_numpy(dtype=np.float64)
+    if 'hour' in chunk.columns:
+        hour = chunk['hour'].to_numpy(dtype=np.float64)
+        day_of_week = chunk['day_of_week'].to_numpy(dtype=np.float64)
+    else:
+        hour, day_of_week = time_features(pd.to_datetime(chunk['timestamp']).to_numpy(), len(chunk))
+    X = np.column_stack([patients, doctors, hour, day_of_week])
+    # Target proxy
+    y = patients * consultation / np.where(doctors > 0, doctors, 1)
+    return X, y
+
+
+def time_features(timestamps, n):
+    """Vectorized (hour, day_of_week) for one datetime or an array of them."""
+    if isinstance(timestamps, datetime):
+        return np.full(n, timestamps.hour), np.full(n, timestamps.weekday())
+    minutes = np.asarray(timestamps, dtype='datetime64[m]')
+    days = minutes.astype('datetime64[D]')
+    hour = (minutes - days).astype(np.int64) // 60
+    # 1970-01-01 was a Thursday (weekday 3, with 0=Mon)
+    day_of_week = (days.astype(np.int64) + 3) % 7
+    return hour, day_of_week
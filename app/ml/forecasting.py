@@ -0,0 +1,151 @@
+import threading
+import time
+from datetime import timedelta
+from sqlalchemy import func, select
+from app import db
+from app.models import OPDQueueHourlyRollup
+from app.metrics import timed
+
+# Monday 00:00, used to give each (weekday, hour) cell a timestamp for the model
+GRID_ORIGIN = '2024-01-01T00:00'
+
+
+class SeasonalForecaster:
+    """Per-department hour x weekday forecasts from the hourly rollup.
+
+    Each department's baseline is two 7x24 arrays (mean patients waiting and
+    mean active doctors per slot), read from ``sc_opd_queue_hourly``, which
+    ingest already keeps up to date. The model is run once over all 168 cells
+    in a single batched call, so serving a forecast is only array indexing.
+    Baselines are reloaded per department when ``invalidate()`` is called
+    after a write, and at the latest every ``FORECAST_BASELINE_REFRESH_SECONDS``
+    so writes made by other workers show up too. The wait grid is recomputed
+    whenever the baseline or the model changes.
+
+    NumPy and pandas are imported on first use, so workers that never serve
+    a forecast don't load them.
+
+    Slots without data fall back to the department's mean for that hour, then
+    its overall mean; departments without any history get the mean of all
+    departments.
+    """
+
+    def __init__(self, app=None):
+        self.refresh_seconds = 300
+        self._baselines = {}
+        self._grids = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.refresh_seconds = app.config['FORECAST_BASELINE_REFRESH_SECONDS']
+        app.extensions['forecaster'] = self
+
+    def invalidate(self, department=None):
+        with self._lock:
+            if department is None:
+                self._baselines.clear()
+                self._grids.clear()
+            else:
+                self._baselines.pop(department, None)
+                self._grids.pop(department, None)
+
+    def baseline(self, department):
+        """(patients, doctors) 7x24 arrays for a department, indexed [weekday, hour]."""
+        with self._lock:
+            entry = self._baselines.get(department)
+        if entry is not None and time.monotonic() - entry['loaded_at'] < self.refresh_seconds:
+            return entry['patients'], entry['doctors']
+        patients, doctors = _load_baseline(department)
+        with self._lock:
+            self._baselines[department] = {'patients': patients, 'doctors': doctors, 'loaded_at': time.monotonic()}
+            # The wait grid was computed from the old baseline
+            self._grids.pop(department, None)
+        return patients, doctors
+
+    def wait_grid(self, predictor, department):
+        """Predicted wait for every (weekday, hour) slot, as a 7x24 array."""
+        import numpy as np
+        patients, doctors = self.baseline(department)
+        with self._lock:
+            entry = self._grids.get(department)
+        if entry is not None and entry['predictor'] is predictor:
+            return entry['waits']
+        cells = np.datetime64(GRID_ORIGIN) + np.arange(7 * 24).astype('timedelta64[h]')
+        waits = predictor.predict_batch(patients.ravel(), doctors.ravel(), cells, department).reshape(7, 24)
+        with self._lock:
+            self._grids[department] = {'predictor': predictor, 'waits': waits}
+        return waits
+
+    @timed('predict_future_slots')
+    def forecast(self, predictor, department, hours=24, start=None):
+        """Hourly wait-time forecast for the next `hours`, starting at `start`."""
+        waits = self.wait_grid(predictor, department)
+        future_times = [start + timedelta(hours=i) for i in range(hours)]
+        slot_waits = waits[[t.weekday() for t in future_times], [t.hour for t in future_times]]
+
+        forecasts = []
+        for future_time, wait_time in zip(future_times, slot_waits.tolist()):
+            # Crowd Intensity
+            intensity = "Low"
+            if wait_time > 60: intensity = "High"
+            elif wait_time > 30: intensity = "Medium"
+
+            forecasts.append({
+                'time': future_time.strftime('%I:%M %p'),
+                'wait_time': round(wait_time, 1),
+                'intensity': intensity,
+                'is_peak': intensity == "High"
+            })
+        return forecasts
+
+
+def _default_baseline():
+    # Fresh installs have no history yet: the old fixed load pattern with 3 doctors
+    import numpy as np
+    hour = np.arange(24)
+    patients = np.select(
+        [(hour >= 9) & (hour <= 12), (hour >= 13) & (hour <= 16), (hour >= 17) & (hour <= 20)],
+        [25, 15, 10],
+        default=5
+    ).astype(np.float64)
+    return np.tile(patients, (7, 1)), np.full((7, 24), 3.0)
+
+
+def _load_baseline(department):
+    import numpy as np
+    import pandas as pd
+    own = pd.read_sql(
+        select(
+            OPDQueueHourlyRollup.day_of_week, OPDQueueHourlyRollup.hour, OPDQueueHourlyRollup.count,
+            OPDQueueHourlyRollup.sum_patients_waiting, OPDQueueHourlyRollup.sum_active_doctors
+        ).where(OPDQueueHourlyRollup.department == department),
+        db.session.connection()
+    )
+    if not len(own):
+        count, patients, doctors = db.session.query(
+            func.sum(OPDQueueHourlyRollup.count), func.sum(OPDQueueHourlyRollup.sum_patients_waiting),
+            func.sum(OPDQueueHourlyRollup.sum_active_doctors)
+        ).one()
+        if not count:
+            return _default_baseline()
+        # Unknown department: the all-department mean for every slot
+        return np.full((7, 24), patients / count), np.full((7, 24), doctors / count)
+
+    grids = []
+    days, slots = own['day_of_week'].to_numpy(), own['hour'].to_numpy()
+    for column in ['sum_patients_waiting', 'sum_active_doctors']:
+        sums, counts = np.zeros((7, 24)), np.zeros((7, 24))
+        sums[days, slots] = own[column].to_numpy(dtype=np.float64)
+        counts[days, slots] = own['count'].to_numpy(dtype=np.float64)
+
+        # Same hour on other weekdays, then the department's overall mean
+        hour_counts = counts.sum(axis=0)
+        hour_means = np.divide(sums.sum(axis=0), hour_counts, out=np.zeros(24), where=hour_counts > 0)
+        fallback = np.where(hour_counts > 0, hour_means, sums.sum() / counts.sum())
+        grids.append(np.where(counts > 0, np.divide(sums, counts, out=np.zeros((7, 24)), where=counts > 0), fallback))
+    return grids[0], grids[1]
+
+
+forecaster = SeasonalForecaster()
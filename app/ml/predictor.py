@@ -1,90 +1,219 @@
+import copy
+import time
 import numpy as np
-import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
-from app.models import OPDQueue
-from datetime import datetime, timedelta
+from app.ml.features import FEATURE_COLUMNS, QueueFeatureLoader, time_features
+from app.metrics import timed
+from app.retention import history_training_frame
+from datetime import datetime
 
 class WaitingDurationPredictor:
-    def __init__(self):
-        self.model = RandomForestRegressor(n_estimators=100, random_state=42)
+    def __init__(self, n_estimators=100, trees_per_update=10, min_update_rows=200, derive_in_sql=False,
+                 department=None, n_jobs=None, recent_trees=20, full_refit_fraction=0.2):
+        self.n_estimators = n_estimators
+        self.trees_per_update = trees_per_update
+        self.min_update_rows = min_update_rows
+        # At most this many trees are fitted on recent rows only; the rest
+        # (the core) come from the last full refit and keep the whole history
+        self.recent_trees = min(recent_trees, n_estimators - 1)
+        # A full refit replaces the incremental update once the rows added
+        # since the last one exceed this share of the rows it was fitted on
+        self.full_refit_fraction = full_refit_fraction
+        self.derive_in_sql = derive_in_sql
+        # Only this department's rows are trained on (None = all departments)
+        self.department = department
+        self.n_jobs = n_jobs
+        from sklearn.ensemble import RandomForestRegressor
+        self.model = RandomForestRegressor(n_estimators=n_estimators, random_state=42)
         self.is_trained = False
-        self.feature_columns = ['patients_waiting', 'active_doctors', 'hour', 'day_of_week']
+        self.feature_columns = list(FEATURE_COLUMNS)
+        # Training watermark: highest OPDQueue id the model has seen
+        self.last_trained_id = 0
+        self.last_trained_timestamp = None
+        # Rows the current trees were fitted on: the core's training set plus
+        # the new rows of the recent batches whose trees are still in the forest
+        self.trained_rows = 0
+        self.core_trees = None
+        self.core_rows = 0
+        # One entry per incremental update still represented: its tree count and new rows
+        self.recent_batches = []
+        self.rows_since_full = 0
+        # Timing / size of the last training run
+        self.train_stats = {}
+        # Set on serving copies only (see serving_copy)
+        self.compact = None
 
-    def train(self):
-        records = OPDQueue.query.all()
-        if not records:
+    @timed('train')
+    def train(self, full=False):
+        """Folds only new rows in, with a full refit on first use, on demand, or
+        once the rows added since the last one outgrow ``full_refit_fraction``
+        of its training set."""
+        return self.fit_prepared(self.prepare_training(full))
+
+    @timed('train.load')
+    def prepare_training(self, full=False):
+        """Loads the training arrays; the (CPU-bound) fit is fit_prepared().
+
+        Split in two so a caller can load in one process and fit in another.
+        """
+        loader = QueueFeatureLoader(derive_in_sql=self.derive_in_sql)
+        if not full and self.is_trained:
+            X, y, meta = loader.training_data(min_id=self.last_trained_id, department=self.department)
+            # Scheduled full refit: the core trees haven't seen enough of the data
+            full = self.core_trees is None or \
+                self.rows_since_full + meta['rows'] > self.full_refit_fraction * max(self.core_rows, 1)
+        if full or not self.is_trained:
+            X, y, meta = loader.training_data(department=self.department)
+            weights = np.ones(len(y))
+            # Rows past the retention window survive as weighted hourly samples
+            history = history_training_frame(self.department)
+            if history is not None:
+                X = np.concatenate([X, history[self.feature_columns].to_numpy(dtype=np.float64)])
+                y = np.concatenate([y, history['estimated_wait'].to_numpy()])
+                weights = np.concatenate([weights, history['weight'].to_numpy()])
+            return {'mode': 'full', 'X': X, 'y': y, 'weights': weights, 'meta': meta, 'stats': loader.stats}
+
+        # Small batches are padded with the most recent already-seen rows so
+        # the new trees don't overfit a handful of points
+        shortfall = self.min_update_rows - meta['rows']
+        if meta['rows'] and shortfall > 0:
+            X_pad, y_pad, _ = loader.training_data(
+                max_id=self.last_trained_id, department=self.department, newest_first=True, limit=shortfall
+            )
+            X, y = np.concatenate([X, X_pad]), np.concatenate([y, y_pad])
+        return {'mode': 'incremental', 'X': X, 'y': y, 'weights': None, 'meta': meta, 'stats': loader.stats}
+
+    @timed('train.fit')
+    def fit_prepared(self, data):
+        if data['mode'] == 'full':
+            return self._fit_full(data)
+        return self._fit_incremental(data)
+
+    def _fit_full(self, data):
+        X, y, weights = data['X'], data['y'], data['weights']
+        if not len(y):
             return False
         
-        data = []
-        for r in records:
-            d = r.to_dict()
-            # Derive features
-            dt = datetime.fromisoformat(d['timestamp'])
-            d['hour'] = dt.hour
-            d['day_of_week'] = dt.weekday() # 0=Mon, 6=Sun
-            # Target proxy
-            d['estimated_wait'] = (d['patients_waiting'] * d['avg_consultation_time']) / (d['active_doctors'] if d['active_doctors'] > 0 else 1)
-            data.append(d)
-            
-        df = pd.DataFrame(data)
-        
-        X = df[self.feature_columns]
-        y = df['estimated_wait']
-        
-        self.model.fit(X, y)
+        fit_start = time.perf_counter()
+        from sklearn.ensemble import RandomForestRegressor
+        # Fit a fresh forest off to the side so concurrent predicts keep
+        # using the old one until the swap
+        model = RandomForestRegressor(n_estimators=self.n_estimators, random_state=42, n_jobs=self.n_jobs)
+        # Fitted on plain arrays so predict_batch can pass a NumPy matrix
+        model.fit(X, y, sample_weight=weights)
+        # Parallel fits only: a thread pool per predict call costs more than
+        # it saves on request-sized batches
+        model.set_params(n_jobs=None)
+        self.model = model
         self.is_trained = True
+        self.trained_rows = self.core_rows = int(weights.sum())
+        self.core_trees = len(model.estimators_)
+        self.recent_batches = []
+        self.rows_since_full = 0
+        self._advance_watermark(data['meta'])
+        self.train_stats = dict(data['stats'], mode='full', core_trees=self.core_trees, recent_trees=0,
+                                fit_seconds=round(time.perf_counter() - fit_start, 4))
         return True
 
-    def predict(self, patients_waiting, active_doctors, timestamp=None):
+    def _fit_incremental(self, data):
+        X, y, meta = data['X'], data['y'], data['meta']
+        if not meta['rows']:
+            return True
+        
+        fit_start = time.perf_counter()
+        # Grow the forest with trees fitted on the new window. Only the recent
+        # share rotates: its oldest trees are retired, and core trees only
+        # give way while that share fills up, so most of the forest always
+        # holds the full history (hour and weekday effects included). The
+        # shallow copy shares the existing (read-only) trees.
+        model = copy.copy(self.model)
+        model.estimators_ = list(self.model.estimators_)
+        model.set_params(warm_start=True, n_estimators=len(model.estimators_) + self.trees_per_update,
+                         n_jobs=self.n_jobs)
+        model.fit(X, y)
+        core = model.estimators_[:self.core_trees]
+        recent = model.estimators_[self.core_trees:][-self.recent_trees:]
+        core = core[:self.n_estimators - len(recent)]
+        model.estimators_ = core + recent
+        model.set_params(warm_start=False, n_estimators=len(model.estimators_), n_jobs=None)
+        self.model = model
+
+        # Drop the batches whose trees were retired (the oldest one may keep a few)
+        batches = list(self.recent_batches) + [{'trees': self.trees_per_update, 'new_rows': meta['rows']}]
+        excess = sum(b['trees'] for b in batches) - len(recent)
+        while excess > 0:
+            retired = min(batches[0]['trees'], excess)
+            batches[0] = dict(batches[0], trees=batches[0]['trees'] - retired)
+            excess -= retired
+            if not batches[0]['trees']:
+                batches.pop(0)
+        self.recent_batches = batches
+        self.core_trees = len(core)
+        self.rows_since_full += meta['rows']
+        self.trained_rows = self.core_rows + sum(b['new_rows'] for b in batches)
+        self._advance_watermark(meta)
+        self.train_stats = {
+            'mode': 'incremental',
+            'rows': len(y),
+            'new_rows': meta['rows'],
+            'core_trees': len(core),
+            'recent_trees': len(recent),
+            'rows_since_full': self.rows_since_full,
+            'fit_seconds': round(time.perf_counter() - fit_start, 4),
+        }
+        return True
+
+    def _advance_watermark(self, meta):
+        if meta['max_id'] is None:
+            return
+        self.last_trained_id = max(self.last_trained_id, meta['max_id'])
+        latest = meta['max_timestamp']
+        if self.last_trained_timestamp is None or latest > self.last_trained_timestamp:
+            self.last_trained_timestamp = latest
+
+    def predict(self, patients_waiting, active_doctors, timestamp=None, department=None):
+        return float(self.predict_batch([patients_waiting], [active_doctors], timestamp, department)[0])
+
+    @timed('predict')
+    def predict_batch(self, patients_waiting, active_doctors, timestamps=None, departments=None):
+        """Predicts many queue states with a single model call.
+
+        `timestamps` may be one datetime applied to every row, or one per row.
+        `departments` is accepted for interface parity with ShardedPredictor;
+        a single model serves every department.
+        """
+        patients_waiting = np.asarray(patients_waiting, dtype=np.float64)
+        active_doctors = np.asarray(active_doctors, dtype=np.float64)
         if not self.is_trained:
             # Fallback heuristic
-            if active_doctors == 0: return 0
-            return (patients_waiting * 10) / active_doctors
+            safe_doctors = np.where(active_doctors == 0, 1, active_doctors)
+            return np.where(active_doctors == 0, 0, (patients_waiting * 10) / safe_doctors)
         
-        if timestamp is None:
-            timestamp = datetime.now()
-            
-        hour = timestamp.hour
-        day_of_week = timestamp.weekday()
+        if timestamps is None:
+            timestamps = datetime.now()
+        hour, day_of_week = time_features(timestamps, len(patients_waiting))
         
-        features = pd.DataFrame([[patients_waiting, active_doctors, hour, day_of_week]], columns=self.feature_columns)
-        return self.model.predict(features)[0]
+        features = np.column_stack([patients_waiting, active_doctors, hour, day_of_week])
+        if self.compact is not None:
+            return self.compact.predict(features)
+        return self.model.predict(features)
 
-    def predict_future_slots(self, department, hours=24):
-        """Generates hourly wait time forecast for the next `hours`."""
-        if not self.is_trained:
-            self.train()
-            
-        forecasts = []
-        current_time = datetime.now()
-        # Assume constant doctors/patients for simplicity or use moving average?
-        # Better: Use historical average for that specific hour/day (baseline)
-        # For prototype, we'll assume 'average' load:
-        # active_doctors = 3, patients_waiting = varies by hour (mocked pattern)
-        
-        for i in range(hours):
-            future_time = current_time + timedelta(hours=i)
-            hour = future_time.hour
-            
-            # Simulated load pattern based on hour
-            mock_patients = 5
-            if 9 <= hour <= 12: mock_patients = 25 # Peak
-            elif 13 <= hour <= 16: mock_patients = 15
-            elif 17 <= hour <= 20: mock_patients = 10
-            
-            # Predict
-            wait_time = self.predict(mock_patients, 3, future_time)
-            
-            # Crowd Intensity
-            intensity = "Low"
-            if wait_time > 60: intensity = "High"
-            elif wait_time > 30: intensity = "Medium"
-            
-            forecasts.append({
-                'time': future_time.strftime('%I:%M %p'),
-                'wait_time': round(wait_time, 1),
-                'intensity': intensity,
-                'is_peak': intensity == "High"
-            })
-            
-        return forecasts
+    def serving_copy(self, max_depth=None, min_samples=None, float32=True):
+        """A predict-only copy backed by a CompactForest instead of the sklearn model.
+
+        It keeps the watermark and stats but cannot be trained further, and
+        unpickling it does not import scikit-learn.
+        """
+        from app.ml.compact import CompactForest
+        served = copy.copy(self)
+        served.compact = CompactForest.from_forest(self.model, max_depth, min_samples, float32)
+        served.model = None
+        return served
+
+    def predict_future_slots(self, department, hours=24, start=None):
+        """Generates hourly wait time forecast for the next `hours`.
+
+        Expected load and staffing come from the department's hour x weekday
+        baseline (see app.ml.forecasting).
+        """
+        from app.ml.forecasting import forecaster
+        return forecaster.forecast(self, department, hours, start or datetime.now())
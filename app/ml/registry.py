@@ -0,0 +1,334 @@
+import fcntl
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+ARTIFACT_PATTERN = re.compile(r'model-v(\d+)\.joblib$')
+# train_model.py's exit status when there was nothing to train on
+NOT_TRAINED_EXIT = 3
+
+
+class ModelRegistry:
+    """On-disk store of versioned predictors; LATEST names the one workers serve."""
+
+    def __init__(self, app=None):
+        self.model_dir = None
+        self.refresh_seconds = 30
+        self.keep_versions = 5
+        self.sharding = False
+        self.train_processes = 0
+        self.n_jobs = None
+        self.compact = False
+        self.compact_options = {}
+        self.retrain_min_rows = 200
+        self._watermark = (None, 0)
+        self._predictor = None
+        self._version = None
+        self._last_check = 0.0
+        self._refreshing = False
+        self.app = None
+        self._lock = threading.Lock()
+        self._train_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.model_dir = app.config['MODEL_DIR']
+        self.refresh_seconds = app.config['MODEL_REFRESH_SECONDS']
+        self.keep_versions = app.config['MODEL_KEEP_VERSIONS']
+        self.sharding = app.config['MODEL_SHARDING']
+        self.train_processes = app.config['MODEL_TRAIN_PROCESSES']
+        self.n_jobs = app.config['MODEL_N_JOBS']
+        self.retrain_min_rows = app.config['MODEL_RETRAIN_MIN_ROWS']
+        self.compact = app.config['MODEL_COMPACT']
+        self.compact_options = {
+            'max_depth': app.config['MODEL_COMPACT_MAX_DEPTH'] or None,
+            'min_samples': app.config['MODEL_COMPACT_MIN_SAMPLES'] or None,
+            'float32': app.config['MODEL_COMPACT_FLOAT32'],
+        }
+        os.makedirs(self.model_dir, exist_ok=True)
+        app.extensions['model_registry'] = self
+        if not app.config['FAST_START']:
+            self.refresh(force=True)
+
+    def current(self):
+        """Returns the process-wide predictor, swapping in newer artifacts."""
+        if time.monotonic() - self._last_check >= self.refresh_seconds:
+            if self._predictor is None:
+                self.refresh()
+            else:
+                # Keep serving the loaded model while a thread loads the new one
+                self._refresh_in_background()
+        if self._predictor is None:
+            with self._lock:
+                if self._predictor is None:
+                    # No artifact yet: serve the untrained fallback heuristic
+                    self._predictor = self._new_predictor()
+        return self._predictor
+
+    def _new_predictor(self):
+        if self.sharding:
+            from app.ml.sharding import ShardedPredictor
+            return ShardedPredictor(processes=self.train_processes or None)
+        from app.ml.predictor import WaitingDurationPredictor
+        return WaitingDurationPredictor(n_jobs=self.n_jobs)
+
+    @property
+    def version(self):
+        return self._version
+
+    def refresh(self, force=False):
+        self._last_check = time.monotonic()
+        latest = self.latest_version()
+        if latest is None or (latest == self._version and not force):
+            return False
+        predictor = self.load(latest, compact=self.compact)
+        with self._lock:
+            self._predictor = predictor
+            self._version = latest
+        return True
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._last_check = time.monotonic()
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            if self.app is not None:
+                self.app.logger.exception('Model refresh failed')
+        finally:
+            self._refreshing = False
+
+    def latest_version(self):
+        try:
+            with open(self._pointer_path()) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def metadata(self, version=None):
+        version = self.latest_version() if version is None else version
+        if version is None:
+            return None
+        with open(self._meta_path(version)) as f:
+            return json.load(f)
+
+    def should_retrain(self, max_id, min_rows=None):
+        """Whether `max_id` is at least `min_rows` past the latest model's watermark."""
+        version = self.latest_version()
+        if version is None:
+            return True
+        if self._watermark[0] != version:
+            try:
+                self._watermark = (version, self.metadata(version)['last_trained_id'])
+            except (OSError, ValueError, KeyError):
+                return True
+        min_rows = self.retrain_min_rows if min_rows is None else min_rows
+        return max_id - self._watermark[1] >= min_rows
+
+    def load(self, version, compact=False):
+        import joblib
+        path = self._artifact_path(version)
+        if compact and os.path.exists(self._compact_path(version)):
+            path = self._compact_path(version)
+        # mmap only covers bare arrays (a compact model's); sklearn trees are copied into memory
+        return joblib.load(path, mmap_mode='r')
+
+    def retrain(self, full=False, in_process=None):
+        """Trains a copy of the latest model and publishes it as a new version."""
+        # compact serving keeps scikit-learn out of web workers, so train in a child
+        if in_process is None:
+            in_process = not (self.compact and not self.sharding)
+        if not in_process:
+            return self._retrain_subprocess(full)
+        # The file lock serializes training across workers, the thread lock within one
+        with self._train_lock, self._file_lock():
+            latest = self.latest_version()
+            if not full and latest is not None and not self.should_retrain(self._max_queue_id(), min_rows=1):
+                # Another worker already trained on these rows
+                return False
+            # Train a private copy of the newest artifact; requests keep using
+            # the live predictor until publish() swaps the new one in
+            predictor = self.load(latest) if latest is not None else self._new_predictor()
+            if self.sharding != hasattr(predictor, 'shard'):
+                # MODEL_SHARDING was switched: start over with the other layout
+                predictor = self._new_predictor()
+                full = True
+            if self.sharding:
+                predictor.processes = self.train_processes or None
+            else:
+                predictor.n_jobs = self.n_jobs
+            previous_id = predictor.last_trained_id
+            trained = predictor.train(full=full)
+            if trained and (full or predictor.last_trained_id != previous_id):
+                self.publish(predictor)
+            return trained
+
+    @contextmanager
+    def _file_lock(self):
+        with open(os.path.join(self.model_dir, '.train.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _max_queue_id(self):
+        from app import db
+        from app.models import OPDQueue
+        return db.session.query(db.func.max(OPDQueue.id)).scalar() or 0
+
+    def _retrain_subprocess(self, full):
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                              'train_model.py')
+        command = [sys.executable, script, '--report-untrained'] + ([] if full else ['--incremental'])
+        # The child reads the same environment; it needs no model at startup
+        env = dict(os.environ, FAST_START='1')
+        with self._train_lock:
+            result = subprocess.run(command, env=env, cwd=os.path.dirname(script),
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            if result.returncode == NOT_TRAINED_EXIT:
+                return False
+            if result.returncode != 0:
+                raise RuntimeError(f'train_model.py exited with {result.returncode}: '
+                                   f'{result.stderr.strip()[-2000:]}')
+            # Swap in the version the child published, if any
+            self.refresh()
+            return True
+
+    def publish(self, predictor):
+        """Writes a new artifact version and points LATEST at it."""
+        import joblib
+        if hasattr(predictor, 'save_shards'):
+            predictor.save_shards(self.model_dir)
+        version = self._claim_version(predictor, joblib)
+        meta = {
+            'version': version,
+            'created_at': datetime.utcnow().isoformat(),
+            'last_trained_id': predictor.last_trained_id,
+            'last_trained_timestamp': predictor.last_trained_timestamp.isoformat()
+            if predictor.last_trained_timestamp else None,
+            'trained_rows': predictor.trained_rows,
+            # Rows of the last full refit, which every core tree was fitted on
+            'core_rows': getattr(predictor, 'core_rows', None),
+            'n_estimators': len(getattr(predictor.model, 'estimators_', [])),
+            'train_stats': getattr(predictor, 'train_stats', {}),
+        }
+        if hasattr(predictor, 'shard_files'):
+            meta['departments'] = predictor.departments
+            meta['shard_files'] = predictor.shard_files()
+        served = predictor
+        if self.compact and hasattr(predictor, 'serving_copy'):
+            served = predictor.serving_copy(**self.compact_options)
+            tmp_path = f'{self._compact_path(version)}.{os.getpid()}.tmp'
+            joblib.dump(served, tmp_path)
+            os.replace(tmp_path, self._compact_path(version))
+            report = self._compact_report(predictor, served)
+            if report is not None:
+                meta['compact'] = report
+        self._write_atomic(self._meta_path(version), json.dumps(meta))
+        # Never move LATEST backwards if a concurrent publisher got there first
+        if version > (self.latest_version() or 0):
+            self._write_atomic(self._pointer_path(), str(version))
+
+        with self._lock:
+            self._predictor = served
+            self._version = version
+        self._prune()
+        return meta
+
+    def _compact_report(self, predictor, served):
+        from app.ml.compact import compare
+        from app.ml.features import QueueFeatureLoader
+        # Accuracy on the most recent rows, which is what gets predicted next
+        X, _, _ = QueueFeatureLoader().training_data(
+            department=predictor.department, newest_first=True, limit=1000
+        )
+        if not len(X):
+            # Nothing to compare on (e.g. a department with no rows yet)
+            return None
+        return compare(predictor.model, served.compact, X, repeats=3)
+
+    def _claim_version(self, predictor, joblib):
+        # O_EXCL creation makes concurrent publishers pick distinct versions
+        version = max(self._versions(), default=0) + 1
+        while True:
+            try:
+                with open(self._artifact_path(version), 'xb') as f:
+                    joblib.dump(predictor, f)
+                return version
+            except FileExistsError:
+                version += 1
+
+    def _prune(self):
+        current = self.latest_version()
+        for version in sorted(self._versions())[:-self.keep_versions]:
+            if version == current:
+                continue
+            for path in (self._artifact_path(version), self._compact_path(version), self._meta_path(version)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self._prune_shards()
+
+    def _prune_shards(self):
+        # Shard files no remaining version refers to; recent ones may belong
+        # to a publish still in progress in another worker
+        shard_dir = os.path.join(self.model_dir, 'shards')
+        if not os.path.isdir(shard_dir):
+            return
+        referenced = set()
+        for version in self._versions():
+            try:
+                referenced.update(self.metadata(version).get('shard_files', []))
+            except (OSError, ValueError):
+                return
+        cutoff = time.time() - 600
+        for name in os.listdir(shard_dir):
+            path = os.path.join(shard_dir, name)
+            if name not in referenced and os.path.getmtime(path) < cutoff:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _versions(self):
+        versions = []
+        for path in glob.glob(os.path.join(self.model_dir, 'model-v*.joblib')):
+            match = ARTIFACT_PATTERN.search(path)
+            if match:
+                versions.append(int(match.group(1)))
+        return versions
+
+    def _write_atomic(self, path, content):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _artifact_path(self, version):
+        return os.path.join(self.model_dir, f'model-v{version:06d}.joblib')
+
+    def _compact_path(self, version):
+        return os.path.join(self.model_dir, f'model-v{version:06d}.compact.joblib')
+
+    def _meta_path(self, version):
+        return os.path.join(self.model_dir, f'model-v{version:06d}.json')
+
+    def _pointer_path(self):
+        return os.path.join(self.model_dir, 'LATEST')
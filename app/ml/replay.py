@@ -0,0 +1,205 @@
+import multiprocessing
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from app.metrics import timed
+from app.ml.anomaly import StreamingIssueDetector, alert_window
+
+REPLAY_COLUMNS = ['id', 'timestamp', 'department', 'patients_waiting', 'active_doctors']
+SEVERITY = {
+    'Sudden Crowd Surge': 'High',
+    'Severe Staff Shortage': 'High',
+    'Rapid Queue Growth': 'Medium',
+}
+
+
+def default_rules():
+    """The thresholds the live detector runs with."""
+    d = StreamingIssueDetector
+    return {
+        'window': d.WINDOW,
+        'min_records': d.MIN_RECORDS,
+        'surge_z': d.SURGE_Z,
+        'shortage_max_doctors': d.SHORTAGE_MAX_DOCTORS,
+        'shortage_min_patients': d.SHORTAGE_MIN_PATIENTS,
+        'growth_lag': d.GROWTH_LAG,
+        'growth_min': d.GROWTH_MIN,
+        'growth_min_patients': d.GROWTH_MIN_PATIENTS,
+        'dedup_seconds': alert_window.seconds,
+    }
+
+
+class AnomalyReplay:
+    """Runs the silent-issue rules over the stored queue history without writing alerts.
+
+    ``sc_opd_queue`` is read once, in id order and in chunks, like the
+    streaming detector sees it. Each chunk is split by department and each
+    department's rows are evaluated together with the tail of its previous
+    chunk, so the rolling windows continue across chunk boundaries. The rules
+    are the ones in StreamingIssueDetector, computed for every row at once
+    with cumulative sums instead of one ring buffer update per row.
+
+    Rule hits are then deduplicated per (issue type, department) like the
+    live alert window, except that the record timestamps stand in for the
+    time the alert would have been raised, and no alert is ever resolved.
+    ``run()`` returns the alerts that would have fired, counts per type and
+    department, and timings.
+
+    Chunks are independent once their context rows are attached, so with
+    ``processes`` > 1 they are evaluated in a process pool while the next
+    chunk is read.
+    """
+
+    def __init__(self, chunk_size=50000, processes=1, **rules):
+        unknown = set(rules) - set(default_rules())
+        if unknown:
+            raise ValueError(f"Unknown rule setting(s): {', '.join(sorted(unknown))}")
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.rules = dict(default_rules(), **rules)
+
+    @timed('replay')
+    def run(self, departments=None):
+        from app.ml.features import QueueFeatureLoader
+        start = time.perf_counter()
+        rules = self.rules
+        # Rows of context a chunk needs from before its first row
+        context = max(rules['window'], rules['growth_lag'])
+        tails = {}
+        jobs = []
+        rows = 0
+
+        pool = None
+        if self.processes and self.processes > 1:
+            # spawn: forking a threaded web worker is not safe
+            pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            # A single department is filtered in SQL, several after reading
+            single = departments[0] if departments is not None and len(departments) == 1 else None
+            for chunk in QueueFeatureLoader(self.chunk_size).iter_chunks(REPLAY_COLUMNS, department=single):
+                if departments is not None:
+                    chunk = chunk[chunk['department'].isin(departments)]
+                rows += len(chunk)
+                for department, part in chunk.groupby('department', sort=False):
+                    patients = part['patients_waiting'].to_numpy(dtype=np.int64)
+                    doctors = part['active_doctors'].to_numpy(dtype=np.int64)
+                    tail_patients, tail_doctors, seen = tails.get(
+                        department, (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0))
+                    patients = np.concatenate([tail_patients, patients])
+                    doctors = np.concatenate([tail_doctors, doctors])
+                    args = (patients, doctors, seen - len(tail_patients), len(tail_patients), rules)
+                    hits = pool.submit(find_rule_hits, *args) if pool else find_rule_hits(*args)
+                    jobs.append((department, part['id'].to_numpy(), part['timestamp'].to_numpy(), hits))
+                    tails[department] = (patients[-context:], doctors[-context:], seen + len(part))
+            read_seconds = time.perf_counter() - start
+            # Results are consumed in submission order, which is id order per department
+            jobs = [(d, ids, ts, hits if isinstance(hits, dict) else hits.result()) for d, ids, ts, hits in jobs]
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        alerts = self._deduplicate(jobs)
+        counts = {issue_type: 0 for issue_type in SEVERITY}
+        per_department = {
+            department: {'rows': seen, 'alerts': {issue_type: 0 for issue_type in SEVERITY}}
+            for department, (_, _, seen) in sorted(tails.items())
+        }
+        for alert in alerts:
+            counts[alert['issue_type']] += 1
+            per_department[alert['department']]['alerts'][alert['issue_type']] += 1
+        total_seconds = time.perf_counter() - start
+        return {
+            'rules': rules,
+            'rows': rows,
+            'counts': counts,
+            'departments': per_department,
+            'alerts': alerts,
+            'timing': {
+                'read_seconds': round(read_seconds, 4),
+                'total_seconds': round(total_seconds, 4),
+                'rows_per_second': round(rows / total_seconds) if total_seconds else None,
+                'processes': self.processes or 1,
+            },
+        }
+
+    def _deduplicate(self, jobs):
+        window = np.timedelta64(int(self.rules['dedup_seconds'] * 1e6), 'us')
+        last = {}
+        alerts = []
+        for department, ids, timestamps, hits in jobs:
+            for issue_type, (positions, values) in hits.items():
+                key = (issue_type, department)
+                for position, value in zip(positions.tolist(), values):
+                    timestamp = timestamps[position]
+                    if key in last and timestamp - last[key] < window:
+                        continue
+                    last[key] = timestamp
+                    alerts.append(self._alert(issue_type, department, int(ids[position]), timestamp, value))
+        alerts.sort(key=lambda a: a['queue_id'])
+        return alerts
+
+    def _alert(self, issue_type, department, queue_id, timestamp, value):
+        # Same wording as the live detector's alerts
+        if issue_type == 'Sudden Crowd Surge':
+            patients, mean = value
+            description = (f"Patient count {patients} in {department} is significantly "
+                           f"higher than usual ({mean:.1f}).")
+        elif issue_type == 'Severe Staff Shortage':
+            patients, doctors = value
+            description = f"Critical: {patients} patients waiting in {department} with only {doctors} doctor(s)."
+        else:
+            description = f"{department} queue grew by {value[0]} patients in short interval."
+        return {
+            'queue_id': queue_id,
+            'timestamp': str(np.datetime64(timestamp, 's')).replace('T', ' '),
+            'department': department,
+            'issue_type': issue_type,
+            'severity': SEVERITY[issue_type],
+            'description': description,
+        }
+
+
+def find_rule_hits(patients, doctors, offset, start, rules):
+    """Rows of one department's chunk that trip each rule.
+
+    ``patients`` / ``doctors`` hold the chunk's rows preceded by ``start``
+    rows of context; ``offset`` is how many of the department's rows came
+    before the first element. Returns {issue type: (positions, values)}
+    with positions relative to the first non-context row. Runs in pool
+    processes, so it only uses its arguments.
+    """
+    window = rules['window']
+    k = np.arange(start, len(patients))
+    # Rows in each row's window (fewer than `window` near the start of history)
+    n = np.minimum(offset + k + 1, window)
+    eligible = n >= rules['min_records']
+
+    sums = np.concatenate([[0], np.cumsum(patients)])
+    sums_sq = np.concatenate([[0], np.cumsum(patients * patients)])
+    total = sums[k + 1] - sums[k + 1 - n]
+    total_sq = sums_sq[k + 1] - sums_sq[k + 1 - n]
+    latest = patients[k]
+    mean = total / n
+    # Sample std (ddof=1), as in DepartmentWindow
+    std = np.sqrt(np.maximum(total_sq - total * total / n, 0) / np.maximum(n - 1, 1))
+    std[n < 2] = 0.0
+
+    z = np.zeros(len(k))
+    np.divide(latest - mean, std, out=z, where=std > 0)
+    surge = eligible & (std > 0) & (z > rules['surge_z'])
+
+    shortage = (eligible & (doctors[k] < rules['shortage_max_doctors'])
+                & (latest > rules['shortage_min_patients']))
+
+    lag = rules['growth_lag']
+    growth = latest - patients[np.maximum(k - lag, 0)]
+    growing = eligible & (n > lag) & (growth > rules['growth_min']) & (latest > rules['growth_min_patients'])
+
+    hits = {}
+    positions = np.flatnonzero(surge)
+    hits['Sudden Crowd Surge'] = (positions, list(zip(latest[positions].tolist(), mean[positions].tolist())))
+    positions = np.flatnonzero(shortage)
+    hits['Severe Staff Shortage'] = (positions, list(zip(latest[positions].tolist(), doctors[k][positions].tolist())))
+    positions = np.flatnonzero(growing)
+    hits['Rapid Queue Growth'] = (positions, [(g,) for g in growth[positions].tolist()])
+    return hits
@@ -0,0 +1,198 @@
+import hashlib
+import multiprocessing
+import os
+import re
+import threading
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import func
+from app import db
+from app.models import OPDQueue
+from app.metrics import timed
+from app.ml.predictor import WaitingDurationPredictor
+
+
+class ShardedPredictor:
+    """One WaitingDurationPredictor per department, plus a global fallback.
+
+    ``train()`` only retrains shards whose department has rows past that
+    shard's watermark. Training data is loaded here (one department at a
+    time, columnar) and the fits run in a process pool, largest first, so
+    training scales with cores and a busy department only occupies one
+    process. Each shard is saved to its own artifact under ``shards/`` when
+    the registry publishes; unchanged shards keep their existing file and are
+    loaded lazily (memory-mapped) the first time a request routes to them.
+
+    Requests for a department without a shard go to the global model, which
+    is trained on every department like the unsharded predictor.
+    """
+
+    def __init__(self, processes=None, **predictor_options):
+        self.processes = processes
+        self.predictor_options = predictor_options
+        self.fallback = WaitingDurationPredictor(**predictor_options)
+        # department -> {'file', 'last_trained_id', 'trained_rows'}
+        self.shard_info = {}
+        self.shard_dir = None
+        self.model = None
+        self.last_trained_id = 0
+        self.last_trained_timestamp = None
+        self.trained_rows = 0
+        self.train_stats = {}
+        self._shards = {}
+        self._unsaved = set()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Shards live in their own artifacts; only their file names are pickled
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        state['_unsaved'] = set()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def is_trained(self):
+        return self.fallback.is_trained
+
+    @property
+    def departments(self):
+        return sorted(self.shard_info)
+
+    def shard(self, department):
+        """The department's predictor, or the global fallback."""
+        if department not in self.shard_info:
+            return self.fallback
+        with self._lock:
+            predictor = self._shards.get(department)
+            if predictor is None:
+                import joblib
+                path = os.path.join(self.shard_dir, self.shard_info[department]['file'])
+                predictor = joblib.load(path, mmap_mode='r')
+                self._shards[department] = predictor
+        return predictor
+
+    @timed('train.sharded')
+    def train(self, full=False):
+        start = time.perf_counter()
+        latest = dict(
+            db.session.query(OPDQueue.department, func.max(OPDQueue.id)).group_by(OPDQueue.department).all()
+        )
+        stale = [
+            d for d, max_id in latest.items()
+            if full or d not in self.shard_info or max_id > self.shard_info[d]['last_trained_id']
+        ]
+        if not stale and self.fallback.is_trained and not full:
+            return True
+
+        # The global model is one more job in the same pool
+        jobs = [(None, self.fallback)] + [
+            (d, self.shard(d) if d in self.shard_info else WaitingDurationPredictor(department=d, **self.predictor_options))
+            for d in stale
+        ]
+        prepared = [(d, predictor, predictor.prepare_training(full)) for d, predictor in jobs]
+        load_seconds = time.perf_counter() - start
+        # Biggest fits first keeps the pool busy until the end
+        prepared.sort(key=lambda job: len(job[2]['y']), reverse=True)
+
+        results = {}
+        processes = self.processes or os.cpu_count() or 1
+        if processes <= 1 or len(prepared) == 1:
+            for d, predictor, data in prepared:
+                results[d] = _fit_shard(predictor, data)
+        else:
+            # spawn: forking a threaded web worker is not safe
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=min(processes, len(prepared)), mp_context=context) as pool:
+                futures = {d: pool.submit(_fit_shard, predictor, data) for d, predictor, data in prepared}
+                results = {d: f.result() for d, f in futures.items()}
+
+        fallback_trained, fallback = results.pop(None)
+        if not fallback_trained:
+            return False
+        with self._lock:
+            for d, (trained, predictor) in results.items():
+                if not trained:
+                    continue
+                self._shards[d] = predictor
+                self._unsaved.add(d)
+                self.shard_info[d] = {
+                    'file': None,
+                    'last_trained_id': predictor.last_trained_id,
+                    'trained_rows': predictor.trained_rows,
+                }
+        self.fallback = fallback
+        self.last_trained_id = fallback.last_trained_id
+        self.last_trained_timestamp = fallback.last_trained_timestamp
+        self.trained_rows = fallback.trained_rows
+        self.train_stats = {
+            'mode': 'full' if full else 'incremental',
+            'shards_trained': sorted(d for d, (trained, _) in results.items() if trained),
+            'processes': processes,
+            'load_seconds': round(load_seconds, 4),
+            'total_seconds': round(time.perf_counter() - start, 4),
+        }
+        return True
+
+    def save_shards(self, model_dir):
+        """Writes retrained shards to their own artifacts (called by the registry on publish)."""
+        import joblib
+        self.shard_dir = os.path.join(model_dir, 'shards')
+        os.makedirs(self.shard_dir, exist_ok=True)
+        with self._lock:
+            for department in sorted(self._unsaved):
+                predictor = self._shards[department]
+                name = f'{_shard_slug(department)}-{predictor.last_trained_id}.joblib'
+                tmp_path = os.path.join(self.shard_dir, f'{name}.{os.getpid()}.tmp')
+                joblib.dump(predictor, tmp_path)
+                os.replace(tmp_path, os.path.join(self.shard_dir, name))
+                self.shard_info[department]['file'] = name
+            self._unsaved.clear()
+
+    def shard_files(self):
+        return sorted(info['file'] for info in self.shard_info.values())
+
+    def predict(self, patients_waiting, active_doctors, timestamp=None, department=None):
+        return self.shard(department).predict(patients_waiting, active_doctors, timestamp)
+
+    def predict_batch(self, patients_waiting, active_doctors, timestamps=None, departments=None):
+        """Routes each row to its department's shard, one model call per department.
+
+        `departments` may be a single department for every row, or one per row.
+        """
+        if departments is None or isinstance(departments, str):
+            return self.shard(departments).predict_batch(patients_waiting, active_doctors, timestamps)
+
+        patients_waiting = np.asarray(patients_waiting, dtype=np.float64)
+        active_doctors = np.asarray(active_doctors, dtype=np.float64)
+        departments = np.asarray(departments, dtype=object)
+        per_row_times = timestamps is not None and not hasattr(timestamps, 'hour')
+        if per_row_times:
+            timestamps = np.asarray(timestamps)
+        result = np.empty(len(patients_waiting))
+        for department in set(departments.tolist()):
+            mask = departments == department
+            result[mask] = self.shard(department).predict_batch(
+                patients_waiting[mask], active_doctors[mask], timestamps[mask] if per_row_times else timestamps
+            )
+        return result
+
+    def predict_future_slots(self, department, hours=24, start=None):
+        return self.shard(department).predict_future_slots(department, hours, start)
+
+
+def _fit_shard(predictor, data):
+    # Runs in a pool process; the fitted predictor is pickled back
+    trained = predictor.fit_prepared(data)
+    return trained, predictor
+
+
+def _shard_slug(department):
+    # Readable and filesystem-safe, with a hash so distinct names never collide
+    digest = hashlib.sha1(department.encode()).hexdigest()[:8]
+    return f"{re.sub(r'[^A-Za-z0-9_-]+', '_', department)[:40]}-{digest}"
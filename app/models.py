@@ -1,9 +1,14 @@
 from datetime import datetime
+from sqlalchemy import event
 from app import db
 
 
 class OPDQueue(db.Model):
     __tablename__ = 'sc_opd_queue'
+    __table_args__ = (
+        # Serves "latest row of a department" lookups without a sort
+        db.Index('ix_sc_opd_queue_department_timestamp', 'department', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     department = db.Column(db.String(50), nullable=False)
@@ -21,6 +26,93 @@ class OPDQueue(db.Model):
             'avg_consultation_time': self.avg_consultation_time
         }
 
+class OPDQueueCurrent(db.Model):
+    # Latest queue state per department, kept up to date on ingest
+    __tablename__ = 'sc_opd_queue_current'
+    department = db.Column(db.String(50), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    patients_waiting = db.Column(db.Integer, nullable=False)
+    active_doctors = db.Column(db.Integer, nullable=False)
+    avg_consultation_time = db.Column(db.Float, nullable=False)
+
+    def to_dict(self):
+        return {
+            'department': self.department,
+            'timestamp': self.timestamp.isoformat(),
+            'patients_waiting': self.patients_waiting,
+            'active_doctors': self.active_doctors,
+            'avg_consultation_time': self.avg_consultation_time
+        }
+
+class OPDQueueHourlyRollup(db.Model):
+    # Running aggregates per department x weekday x hour, kept up to date on ingest
+    __tablename__ = 'sc_opd_queue_hourly'
+    __table_args__ = (
+        db.UniqueConstraint('department', 'day_of_week', 'hour', name='uq_sc_opd_queue_hourly_slot'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    department = db.Column(db.String(50), nullable=False)
+    day_of_week = db.Column(db.Integer, nullable=False) # 0=Mon, 6=Sun
+    hour = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    sum_patients_waiting = db.Column(db.Float, nullable=False, default=0)
+    sum_active_doctors = db.Column(db.Float, nullable=False, default=0)
+    sum_consultation_time = db.Column(db.Float, nullable=False, default=0)
+
+    def to_dict(self):
+        n = self.count or 1
+        return {
+            'department': self.department,
+            'day_of_week': self.day_of_week,
+            'hour': self.hour,
+            'count': self.count,
+            'mean_patients_waiting': self.sum_patients_waiting / n,
+            'mean_active_doctors': self.sum_active_doctors / n,
+            'mean_consultation_time': self.sum_consultation_time / n
+        }
+
+class OPDQueueHourlyHistory(db.Model):
+    # Downsampled raw rows older than the retention window, one row per department-hour
+    __tablename__ = 'sc_opd_queue_history_hourly'
+    __table_args__ = (
+        db.UniqueConstraint('department', 'bucket_start', name='uq_sc_opd_queue_history_hourly_bucket'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    department = db.Column(db.String(50), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False, index=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    sum_patients_waiting = db.Column(db.Float, nullable=False, default=0)
+    sum_active_doctors = db.Column(db.Float, nullable=False, default=0)
+    sum_consultation_time = db.Column(db.Float, nullable=False, default=0)
+    max_patients_waiting = db.Column(db.Integer, nullable=False, default=0)
+
+class OPDQueueDailyHistory(db.Model):
+    # Same as OPDQueueHourlyHistory, one row per department-day
+    __tablename__ = 'sc_opd_queue_history_daily'
+    __table_args__ = (
+        db.UniqueConstraint('department', 'bucket_start', name='uq_sc_opd_queue_history_daily_bucket'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    department = db.Column(db.String(50), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False, index=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    sum_patients_waiting = db.Column(db.Float, nullable=False, default=0)
+    sum_active_doctors = db.Column(db.Float, nullable=False, default=0)
+    sum_consultation_time = db.Column(db.Float, nullable=False, default=0)
+    max_patients_waiting = db.Column(db.Integer, nullable=False, default=0)
+
+class UploadJobProgress(db.Model):
+    # Committed position of a streaming CSV upload, updated in the same
+    # transaction as the rows it covers
+    __tablename__ = 'sc_upload_jobs'
+    id = db.Column(db.String(32), primary_key=True)
+    bytes_committed = db.Column(db.BigInteger, nullable=False, default=0)
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    rejected = db.Column(db.Integer, nullable=False, default=0)
+    chunks_committed = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -37,11 +129,26 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _forget_cached_user(mapper, connection, target):
+    # A changed role or password must not be served from the login cache
+    from app import user_cache
+    user_cache.invalidate(target.id)
+
 class SilentIssue(db.Model):
     __tablename__ = 'sc_silent_issues'
+    __table_args__ = (
+        # Dedup lookup: newest open alert of a type for a department
+        db.Index('ix_sc_silent_issues_dedup', 'issue_type', 'department', 'is_resolved', 'timestamp'),
+        # Unresolved-alert feed, newest first
+        db.Index('ix_sc_silent_issues_feed', 'is_resolved', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     issue_type = db.Column(db.String(50), nullable=False) # e.g., "Unexpected Congestion", "Efficiency Drop"
+    department = db.Column(db.String(50)) # None for alerts not tied to one department
     severity = db.Column(db.String(20), nullable=False) # Low, Medium, High
     description = db.Column(db.String(250))
     is_resolved = db.Column(db.Boolean, default=False)
@@ -51,6 +158,7 @@ class SilentIssue(db.Model):
             'id': self.id,
             'timestamp': self.timestamp.isoformat(),
             'issue_type': self.issue_type,
+            'department': self.department,
             'severity': self.severity,
             'description': self.description,
             'is_resolved': self.is_resolved
@@ -0,0 +1,139 @@
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+
+class PostIngestPipeline:
+    """Background queue of coalescing post-ingest tasks, run by per-lane worker threads."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.workers = 1
+        self._tasks = {}
+        self._pending = {}
+        self._running = {}
+        self._completed = deque(maxlen=50)
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config['PIPELINE_WORKERS']
+        self._completed = deque(maxlen=app.config['PIPELINE_HISTORY'])
+        app.extensions['pipeline'] = self
+
+    def register(self, name, func, delay=0, lane='default'):
+        self._tasks[name] = (func, delay, lane)
+
+    def submit(self, name):
+        """Queues a registered task, or merges into the pending one."""
+        # Tasks catch up from the database themselves, so merging loses nothing
+        func, delay, _ = self._tasks[name]
+        delay = self.app.config.get(f'PIPELINE_{name.upper()}_DELAY', delay)
+        if self.workers <= 0:
+            job = self._new_job(name, time.time())
+            self._execute(job, func)
+            return _public(job)
+
+        self._ensure_workers()
+        with self._cond:
+            job = self._pending.get(name)
+            if job is not None:
+                job['coalesced'] += 1
+                return _public(job)
+            job = self._new_job(name, time.time() + delay)
+            self._pending[name] = job
+            self._cond.notify_all()
+            return _public(job)
+
+    def status(self):
+        with self._cond:
+            return {
+                'pending': [_public(j) for j in self._pending.values()],
+                'running': [_public(j) for j in self._running.values()],
+                'completed': [_public(j) for j in reversed(self._completed)],
+            }
+
+    def _new_job(self, name, due):
+        return {
+            'id': next(self._ids),
+            'task': name,
+            'status': 'pending',
+            'coalesced': 0,
+            'submitted_at': datetime.utcnow().isoformat(),
+            'due_at': datetime.utcfromtimestamp(due).isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'duration_ms': None,
+            'result': None,
+            'error': None,
+            '_due': due,
+        }
+
+    def _ensure_workers(self):
+        # Threads don't survive a fork, so (re)start them in each worker process
+        if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+            return
+        with self._cond:
+            if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+                return
+            self._pid = os.getpid()
+            lanes = sorted({lane for _, _, lane in self._tasks.values()})
+            self._threads = [
+                threading.Thread(target=self._work, args=(lane,), name=f'pipeline-{lane}-{i}', daemon=True)
+                for lane in lanes for i in range(self.workers)
+            ]
+            for t in self._threads:
+                t.start()
+
+    def _work(self, lane):
+        while True:
+            with self._cond:
+                job = self._next_due(lane)
+                while job is None:
+                    due = [j['_due'] for j in self._pending.values()
+                           if j['task'] not in self._running and self._tasks[j['task']][2] == lane]
+                    self._cond.wait(timeout=max(min(due) - time.time(), 0.01) if due else None)
+                    job = self._next_due(lane)
+                del self._pending[job['task']]
+                self._running[job['task']] = job
+            self._execute(job, self._tasks[job['task']][0])
+            with self._cond:
+                del self._running[job['task']]
+                self._cond.notify_all()
+
+    def _next_due(self, lane):
+        # A task never runs twice at once; a new submission waits for the running one
+        now = time.time()
+        for job in self._pending.values():
+            if job['_due'] <= now and job['task'] not in self._running and self._tasks[job['task']][2] == lane:
+                return job
+        return None
+
+    def _execute(self, job, func):
+        job['status'] = 'running'
+        job['started_at'] = datetime.utcnow().isoformat()
+        start = time.perf_counter()
+        try:
+            with self.app.app_context():
+                job['result'] = func()
+            job['status'] = 'completed'
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+            self.app.logger.exception('Pipeline task %s failed', job['task'])
+        job['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        job['finished_at'] = datetime.utcnow().isoformat()
+        with self._cond:
+            self._completed.append(job)
+
+
+def _public(job):
+    return {k: v for k, v in job.items() if not k.startswith('_')}
@@ -0,0 +1,205 @@
+import os
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from sqlalchemy import case, delete, func, select
+from app import db
+from app.models import OPDQueue, OPDQueueDailyHistory, OPDQueueHourlyHistory
+from app.rollups import upsert_insert
+
+RAW_COLUMNS = ['id', 'timestamp', 'department', 'patients_waiting', 'active_doctors', 'avg_consultation_time']
+HISTORY_SUMS = ['count', 'sum_patients_waiting', 'sum_active_doctors', 'sum_consultation_time']
+
+
+class RetentionManager:
+    """Moves raw queue rows older than the retention window out of sc_opd_queue.
+
+    Works one calendar day at a time, oldest first: the day's raw rows are
+    archived to a compressed file, folded into the hourly and daily history
+    tables, then deleted, all before the next day starts. Each day commits on
+    its own, so a run can be interrupted and simply started again.
+    """
+
+    def __init__(self, raw_days=90, archive_dir='archive', archive_format='csv'):
+        self.raw_days = raw_days
+        self.archive_dir = archive_dir
+        self.archive_format = archive_format
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            raw_days=config['RETENTION_RAW_DAYS'],
+            archive_dir=config['ARCHIVE_DIR'],
+            archive_format=config['ARCHIVE_FORMAT']
+        )
+
+    def run(self, max_days=None, now=None):
+        now = now or datetime.utcnow()
+        # Only whole days leave the raw table
+        cutoff = (now - timedelta(days=self.raw_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+        report = {'cutoff': cutoff.isoformat(), 'days': []}
+        while max_days is None or len(report['days']) < max_days:
+            oldest = db.session.query(func.min(OPDQueue.timestamp)).filter(OPDQueue.timestamp < cutoff).scalar()
+            if oldest is None:
+                break
+            day_start = oldest.replace(hour=0, minute=0, second=0, microsecond=0)
+            report['days'].append(self._process_day(day_start, min(day_start + timedelta(days=1), cutoff)))
+        return report
+
+    def _process_day(self, start, end):
+        in_day = (OPDQueue.timestamp >= start, OPDQueue.timestamp < end)
+        df = pd.read_sql(
+            select(*(getattr(OPDQueue, c) for c in RAW_COLUMNS)).where(*in_day).order_by(OPDQueue.id),
+            db.session.connection()
+        )
+        try:
+            path = self._archive(df, start)
+            _merge_history(OPDQueueHourlyHistory, _downsample(df, 'h'))
+            _merge_history(OPDQueueDailyHistory, _downsample(df, 'D'))
+            # Only delete what was archived; rows arriving meanwhile wait for the next run
+            db.session.execute(delete(OPDQueue).where(*in_day, OPDQueue.id <= int(df['id'].max())))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return {'day': start.date().isoformat(), 'rows': len(df), 'archive': path}
+
+    def _archive(self, df, day):
+        folder = os.path.join(self.archive_dir, f'{day:%Y}', f'{day:%m}')
+        os.makedirs(folder, exist_ok=True)
+        # The id range makes re-runs of the same rows overwrite, not duplicate
+        stem = f"sc_opd_queue_{day:%Y-%m-%d}_{df['id'].min()}-{df['id'].max()}"
+
+        if self.archive_format == 'parquet':
+            try:
+                import pyarrow  # noqa: F401  (optional dependency)
+            except ImportError:
+                pass
+            else:
+                path = os.path.join(folder, f'{stem}.parquet')
+                df.to_parquet(path + '.tmp', index=False, compression='zstd')
+                os.replace(path + '.tmp', path)
+                return path
+
+        path = os.path.join(folder, f'{stem}.csv.gz')
+        df.to_csv(path + '.tmp', index=False, compression='gzip')
+        os.replace(path + '.tmp', path)
+        return path
+
+
+def _downsample_frame(df, freq):
+    buckets = pd.DataFrame({
+        'department': df['department'],
+        'bucket_start': pd.to_datetime(df['timestamp']).dt.floor(freq),
+        'patients_waiting': df['patients_waiting'],
+        'active_doctors': df['active_doctors'],
+        'avg_consultation_time': df['avg_consultation_time'],
+    })
+    return buckets.groupby(['department', 'bucket_start'], as_index=False).agg(
+        count=('patients_waiting', 'size'),
+        sum_patients_waiting=('patients_waiting', 'sum'),
+        sum_active_doctors=('active_doctors', 'sum'),
+        sum_consultation_time=('avg_consultation_time', 'sum'),
+        max_patients_waiting=('patients_waiting', 'max'),
+    )
+
+
+def _downsample(df, freq):
+    grouped = _downsample_frame(df, freq)
+    rows = [dict(zip(grouped.columns, values)) for values in zip(*(grouped[c].tolist() for c in grouped.columns))]
+    for row in rows:
+        row['bucket_start'] = pd.Timestamp(row['bucket_start']).to_pydatetime()
+    return rows
+
+
+def _merge_history(model, rows):
+    """Adds downsampled buckets to a history table (buckets may already exist)."""
+    if not rows:
+        return
+    table = model.__table__
+    insert = upsert_insert()
+    if insert is not None:
+        stmt = insert(table)
+        updates = {c: table.c[c] + stmt.excluded[c] for c in HISTORY_SUMS}
+        updates['max_patients_waiting'] = case(
+            (stmt.excluded.max_patients_waiting > table.c.max_patients_waiting, stmt.excluded.max_patients_waiting),
+            else_=table.c.max_patients_waiting
+        )
+        db.session.execute(stmt.on_conflict_do_update(index_elements=['department', 'bucket_start'], set_=updates), rows)
+        return
+
+    for row in rows:
+        bucket = model.query.filter_by(department=row['department'], bucket_start=row['bucket_start']).first()
+        if bucket is None:
+            db.session.add(model(**row))
+        else:
+            for c in HISTORY_SUMS:
+                setattr(bucket, c, getattr(bucket, c) + row[c])
+            bucket.max_patients_waiting = max(bucket.max_patients_waiting, row['max_patients_waiting'])
+
+
+def hourly_history(department=None, start=None, end=None):
+    """Hourly per-department queue aggregates over the full history.
+
+    Downsampled history and still-raw rows are combined, so callers don't
+    need to know where the retention cutoff currently is.
+    """
+    return _history(OPDQueueHourlyHistory, 'h', department, start, end)
+
+
+def daily_history(department=None, start=None, end=None):
+    """Same as hourly_history, one bucket per department-day."""
+    return _history(OPDQueueDailyHistory, 'D', department, start, end)
+
+
+def _history(model, freq, department, start, end):
+    raw = select(*(getattr(OPDQueue, c) for c in RAW_COLUMNS[1:]))
+    summary = select(
+        model.department, model.bucket_start,
+        *(getattr(model, c) for c in HISTORY_SUMS + ['max_patients_waiting'])
+    )
+    if department is not None:
+        raw = raw.where(OPDQueue.department == department)
+        summary = summary.where(model.department == department)
+    if start is not None:
+        raw = raw.where(OPDQueue.timestamp >= start)
+        summary = summary.where(model.bucket_start >= start)
+    if end is not None:
+        raw = raw.where(OPDQueue.timestamp < end)
+        summary = summary.where(model.bucket_start < end)
+
+    conn = db.session.connection()
+    frames = [pd.read_sql(summary, conn), _downsample_frame(pd.read_sql(raw, conn), freq)]
+    frames = [f for f in frames if len(f)]
+    if not frames:
+        return pd.DataFrame(columns=['department', 'bucket_start'] + HISTORY_SUMS + ['max_patients_waiting'])
+    # A bucket can straddle the cutoff, so merge duplicates
+    return pd.concat(frames, ignore_index=True).groupby(['department', 'bucket_start'], as_index=False).agg(
+        **{c: (c, 'sum') for c in HISTORY_SUMS}, max_patients_waiting=('max_patients_waiting', 'max')
+    )
+
+
+def history_training_frame(department=None):
+    """Training samples from the hourly history: one per bucket, weighted by its row count."""
+    query = select(
+        OPDQueueHourlyHistory.bucket_start,
+        *(getattr(OPDQueueHourlyHistory, c) for c in HISTORY_SUMS)
+    )
+    if department is not None:
+        query = query.where(OPDQueueHourlyHistory.department == department)
+    df = pd.read_sql(query, db.session.connection())
+    if not len(df):
+        return None
+    count = df['count'].to_numpy(dtype=np.float64)
+    patients = df['sum_patients_waiting'].to_numpy() / count
+    doctors = df['sum_active_doctors'].to_numpy() / count
+    consultation = df['sum_consultation_time'].to_numpy() / count
+    ts = pd.to_datetime(df['bucket_start'])
+    return pd.DataFrame({
+        'patients_waiting': patients,
+        'active_doctors': doctors,
+        'hour': ts.dt.hour.to_numpy(),
+        'day_of_week': ts.dt.weekday.to_numpy(),
+        'estimated_wait': patients * consultation / np.where(doctors > 0, doctors, 1),
+        'weight': count,
+    })
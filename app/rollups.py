@@ -0,0 +1,201 @@
+from sqlalchemy import func, select
+from app import db
+from app.models import OPDQueue, OPDQueueCurrent, OPDQueueHourlyHistory, OPDQueueHourlyRollup
+
+SLOT_COLUMNS = ['department', 'day_of_week', 'hour']
+SUM_COLUMNS = ['count', 'sum_patients_waiting', 'sum_active_doctors', 'sum_consultation_time']
+STATE_COLUMNS = ['timestamp', 'patients_waiting', 'active_doctors', 'avg_consultation_time']
+# pandas is imported inside the frame helpers only, so the per-entry path
+# (/api/queue/update) doesn't load it
+
+
+def rollup_increments(frame):
+    """Aggregates queue rows (a DataFrame) into per-slot increments."""
+    import pandas as pd
+    ts = pd.to_datetime(frame['timestamp'])
+    grouped = pd.DataFrame({
+        'department': frame['department'].to_numpy(),
+        'day_of_week': ts.dt.weekday.to_numpy(),
+        'hour': ts.dt.hour.to_numpy(),
+        'count': 1,
+        'sum_patients_waiting': frame['patients_waiting'].to_numpy(dtype=float),
+        'sum_active_doctors': frame['active_doctors'].to_numpy(dtype=float),
+        'sum_consultation_time': frame['avg_consultation_time'].to_numpy(dtype=float),
+    }).groupby(SLOT_COLUMNS, as_index=False).sum()
+    return [
+        dict(zip(grouped.columns, values))
+        for values in zip(*(grouped[c].tolist() for c in grouped.columns))
+    ]
+
+
+def entry_increment(entry):
+    return {
+        'department': entry.department,
+        'day_of_week': entry.timestamp.weekday(),
+        'hour': entry.timestamp.hour,
+        'count': 1,
+        'sum_patients_waiting': float(entry.patients_waiting),
+        'sum_active_doctors': float(entry.active_doctors),
+        'sum_consultation_time': float(entry.avg_consultation_time),
+    }
+
+
+def merge_increments(increments):
+    """Sums increments that fall into the same slot (one upsert row per slot)."""
+    merged = {}
+    for inc in increments:
+        key = tuple(inc[c] for c in SLOT_COLUMNS)
+        if key in merged:
+            for c in SUM_COLUMNS:
+                merged[key][c] += inc[c]
+        else:
+            merged[key] = dict(inc)
+    return list(merged.values())
+
+
+def apply_increments(increments):
+    """Adds increments to the rollup in the current transaction (caller commits)."""
+    if not increments:
+        return
+    table = OPDQueueHourlyRollup.__table__
+    insert = upsert_insert()
+    if insert is not None:
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=SLOT_COLUMNS,
+            set_={c: table.c[c] + stmt.excluded[c] for c in SUM_COLUMNS}
+        )
+        db.session.execute(stmt, increments)
+        return
+
+    # Portable fallback for databases without ON CONFLICT
+    for inc in increments:
+        slot = OPDQueueHourlyRollup.query.filter_by(
+            department=inc['department'], day_of_week=inc['day_of_week'], hour=inc['hour']
+        ).first()
+        if slot is None:
+            db.session.add(OPDQueueHourlyRollup(**inc))
+        else:
+            for c in SUM_COLUMNS:
+                setattr(slot, c, getattr(slot, c) + inc[c])
+
+
+def snapshot_rows(frame):
+    """Latest row (by timestamp, ties going to the later row) per department."""
+    import pandas as pd
+    order = pd.to_datetime(frame['timestamp']).reset_index(drop=True).sort_values(kind='stable').index
+    latest = frame.iloc[order].drop_duplicates('department', keep='last')
+    rows = [
+        dict(zip(['department'] + STATE_COLUMNS, values))
+        for values in zip(*(latest[c].tolist() for c in ['department'] + STATE_COLUMNS))
+    ]
+    for row in rows:
+        row['timestamp'] = pd.Timestamp(row['timestamp']).to_pydatetime()
+    return rows
+
+
+def entry_snapshot(entry):
+    return {c: getattr(entry, c) for c in ['department'] + STATE_COLUMNS}
+
+
+def latest_snapshots(rows):
+    """Keeps the latest row per department (ties going to the later row)."""
+    latest = {}
+    for row in rows:
+        current = latest.get(row['department'])
+        if current is None or row['timestamp'] >= current['timestamp']:
+            latest[row['department']] = row
+    return list(latest.values())
+
+
+def apply_snapshot(rows):
+    """Moves each department's current state forward (never back) in the current transaction."""
+    if not rows:
+        return
+    table = OPDQueueCurrent.__table__
+    insert = upsert_insert()
+    if insert is not None:
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['department'],
+            set_={c: stmt.excluded[c] for c in STATE_COLUMNS},
+            where=stmt.excluded.timestamp >= table.c.timestamp
+        )
+        db.session.execute(stmt, rows)
+        return
+
+    for row in rows:
+        current = db.session.get(OPDQueueCurrent, row['department'])
+        if current is None:
+            db.session.add(OPDQueueCurrent(**row))
+        elif row['timestamp'] >= current.timestamp:
+            for c in STATE_COLUMNS:
+                setattr(current, c, row[c])
+
+
+def upsert_insert():
+    # Dialect insert() with ON CONFLICT support, or None
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+
+def rebuild_rollups(chunk_size=50000):
+    """Recomputes the whole rollup from sc_opd_queue, e.g. after a backfill."""
+    import pandas as pd
+    db.session.query(OPDQueueHourlyRollup).delete()
+    query = select(
+        OPDQueue.timestamp, OPDQueue.department, OPDQueue.patients_waiting,
+        OPDQueue.active_doctors, OPDQueue.avg_consultation_time
+    )
+    totals = None
+    rows = 0
+    for chunk in pd.read_sql(query, db.session.connection(), chunksize=chunk_size):
+        rows += len(chunk)
+        part = pd.DataFrame(rollup_increments(chunk))
+        totals = part if totals is None else \
+            pd.concat([totals, part]).groupby(SLOT_COLUMNS, as_index=False).sum()
+    
+    # Rows already moved out by retention live on in the hourly history
+    history = pd.read_sql(
+        select(
+            OPDQueueHourlyHistory.department, OPDQueueHourlyHistory.bucket_start,
+            *(getattr(OPDQueueHourlyHistory, c) for c in SUM_COLUMNS)
+        ),
+        db.session.connection()
+    )
+    if len(history):
+        ts = pd.to_datetime(history.pop('bucket_start'))
+        part = history.assign(day_of_week=ts.dt.weekday, hour=ts.dt.hour) \
+            .groupby(SLOT_COLUMNS, as_index=False)[SUM_COLUMNS].sum()
+        totals = part if totals is None else \
+            pd.concat([totals, part]).groupby(SLOT_COLUMNS, as_index=False).sum()
+    if totals is not None:
+        db.session.execute(OPDQueueHourlyRollup.__table__.insert(), [
+            dict(zip(totals.columns, values))
+            for values in zip(*(totals[c].tolist() for c in totals.columns))
+        ])
+    db.session.commit()
+    return rows
+
+
+def rebuild_current_snapshot():
+    """Recomputes the latest-state-per-department table from sc_opd_queue."""
+    db.session.query(OPDQueueCurrent).delete()
+    rn = func.row_number().over(
+        partition_by=OPDQueue.department,
+        order_by=(OPDQueue.timestamp.desc(), OPDQueue.id.desc())
+    ).label('rn')
+    ranked = select(OPDQueue.department, *(getattr(OPDQueue, c) for c in STATE_COLUMNS), rn).subquery()
+    rows = db.session.execute(
+        select(*(ranked.c[c] for c in ['department'] + STATE_COLUMNS)).where(ranked.c.rn == 1)
+    ).mappings().all()
+    if rows:
+        db.session.execute(OPDQueueCurrent.__table__.insert(), [dict(r) for r in rows])
+    db.session.commit()
+    return len(rows)
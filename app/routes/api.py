@@ -1,14 +1,38 @@
-from flask import Blueprint, request, jsonify
-from app import db
-from app.models import OPDQueue, SilentIssue
-from datetime import datetime, timedelta
-from app.ml.predictor import WaitingDurationPredictor
-from app.ml.anomaly import SilentIssueDetector
-import pandas as pd
+from flask import Blueprint, Response, request, jsonify, current_app, url_for
+from flask_login import current_user
+from app import db, model_registry, forecast_cache, pipeline
+from app.models import OPDQueue, OPDQueueCurrent, OPDQueueHourlyRollup, SilentIssue
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import and_, false, func, or_
+from app.ml.anomaly import StreamingIssueDetector
+from app.events import event_broker
+from app.ml.forecasting import forecaster
+from app.rollups import apply_increments, apply_snapshot, entry_increment, entry_snapshot, latest_snapshots, merge_increments
 import io
+import json
+import math
 
 api_bp = Blueprint('api', __name__)
 
+# pandas/NumPy (app.ingest, app.ml.*) are imported inside the handlers that
+# need them, so workers serving only views and light endpoints never load them
+_upload_jobs = None
+
+def upload_jobs():
+    global _upload_jobs
+    if _upload_jobs is None:
+        from app.ingest import StreamingUploadJobs
+        _upload_jobs = StreamingUploadJobs()
+    return _upload_jobs
+
+MAX_BATCH_PREDICTIONS = 10000
+DEFAULT_ALERT_PAGE = 50
+MAX_ALERT_PAGE = 200
+MAX_UPDATE_BATCH = 1000
+# Default and longest range of /api/analytics/history per resolution, in days
+HISTORY_RANGE_DAYS = {'hour': (7, 93), 'day': (365, 3660)}
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
 # Initialize ML modules
 # ... (rest of init code) ...
 
@@ -20,79 +44,271 @@ def upload_queue_csv():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
         
+    # Large files: import in the background and hand back a job id to poll
+    if request.args.get('mode', request.form.get('mode')) == 'stream':
+        try:
+            job = upload_jobs().start(current_app._get_current_object(), file, on_complete=_after_upload)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+        return jsonify({
+            'message': 'Upload accepted for streaming import',
+            'job_id': job['id'],
+            'status_url': url_for('api.get_upload_job', job_id=job['id']),
+            'job': job
+        }), 202
+        
     try:
+        import pandas as pd
+        from app.ingest import BulkQueueIngestor, IngestError, REQUIRED_COLUMNS
         # Read CSV directly into dataframe
-        df = pd.read_csv(file)
+        try:
+            df = pd.read_csv(file)
+        except pd.errors.EmptyDataError:
+            return jsonify({'error': 'CSV file is empty'}), 400
+        
+        ingestor = BulkQueueIngestor(chunk_size=current_app.config['INGEST_CHUNK_SIZE'])
         
         # Validate columns
-        required_cols = ['department', 'patients_waiting', 'active_doctors', 'avg_consultation_time']
-        if not all(col in df.columns for col in required_cols):
-            return jsonify({'error': f'Missing columns. Required: {required_cols}'}), 400
+        if ingestor.missing_columns(df.columns):
+            return jsonify({'error': f'Missing columns. Required: {REQUIRED_COLUMNS}'}), 400
+        if not len(df):
+            return jsonify({'error': 'CSV file has no data rows'}), 400
             
-        count = 0
-        for _, row in df.iterrows():
-            new_entry = OPDQueue(
-                department=row['department'],
-                patients_waiting=int(row['patients_waiting']),
-                active_doctors=int(row['active_doctors']),
-                avg_consultation_time=float(row['avg_consultation_time'])
-            )
-            # Optional: Add timestamp if provided in CSV, else default to now
-            if 'timestamp' in row:
-                try:
-                    new_entry.timestamp = datetime.fromisoformat(str(row['timestamp']))
-                except:
-                    pass
-                    
-            db.session.add(new_entry)
-            count += 1
-            
-        db.session.commit()
-        
-        # Retrain model with new historical data
-        predictor.train()
+        # Coerce whole columns at once and insert in chunks
+        try:
+            report = ingestor.ingest(df)
+        except IngestError as e:
+            # Earlier chunks are committed: say how far, so the client doesn't re-upload them
+            if e.committed_rows:
+                _after_upload()
+            return jsonify(e.to_dict()), 500
         
-        # Trigger quick analysis on latest data point
-        anomaly_detector.analyze_recent_data()
+        _after_upload(report['departments'])
         
-        return jsonify({'message': 'File processed successfully', 'count': count}), 201
+        return jsonify({'message': 'File processed successfully', **report}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _after_upload(departments=None):
+    # Forecasts for the touched departments (or all, if unknown) are stale now
+    if departments is None:
+        forecast_cache.invalidate()
+        forecaster.invalidate()
+    for dept in departments or []:
+        forecast_cache.invalidate(dept)
+        forecaster.invalidate(dept)
+    
+    # Retraining and anomaly analysis run in the background pipeline
+    pipeline.submit('retrain')
+    pipeline.submit('rescan')
+    event_broker.notify()
+
+@api_bp.route('/queue/upload/jobs/<job_id>', methods=['GET'])
+def get_upload_job(job_id):
+    job = upload_jobs().get(current_app._get_current_object(), job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@api_bp.route('/queue/upload/jobs/<job_id>/resume', methods=['POST'])
+def resume_upload_job(job_id):
+    job = upload_jobs().resume(current_app._get_current_object(), job_id, on_complete=_after_upload)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 202
+
 # Initialize ML modules
-predictor = WaitingDurationPredictor()
-# Train on startup (in real world, load pickled model)
-with api_bp.open_resource('../../init_db.py') as f: # Hack to get app context? No, just do standard init
-     # We can't easily train here without app context if DB is needed. 
-     # We'll lazy load or train in the route for the prototype.
-     pass
+# The trained predictor is served from model_registry (loaded from disk)
+anomaly_detector = StreamingIssueDetector()
+
+# Post-ingest background tasks (coalesced, see app/pipeline.py)
+def _retrain_task():
+    # Retrain model with new historical data and publish it to all workers
+    trained = model_registry.retrain()
+    event_broker.notify()
+    return {'trained': trained, 'model_version': model_registry.version}
+
+def _retrain_full_task():
+    # Refit on the whole history (POST /api/model/train?full=1)
+    trained = model_registry.retrain(full=True)
+    event_broker.notify()
+    return {'trained': trained, 'model_version': model_registry.version}
+
+def _detect_task():
+    # Fold in rows since the last run and check the departments they touched
+    departments = anomaly_detector.sync()
+    event_broker.notify()
+    return {'departments': sorted(departments)}
+
+def _rescan_task():
+    # Full resync after bulk loads, whose timestamps may be out of id order
+    departments = anomaly_detector.analyze_recent_data()
+    event_broker.notify()
+    return {'departments': sorted(departments)}
 
-anomaly_detector = SilentIssueDetector()
+# Training gets its own lane so alerts never wait behind a forest fit
+pipeline.register('retrain', _retrain_task, delay=5, lane='train')
+pipeline.register('retrain_full', _retrain_full_task, lane='train')
+pipeline.register('detect', _detect_task)
+pipeline.register('rescan', _rescan_task)
 
 @api_bp.route('/queue/update', methods=['POST'])
 def update_queue():
-    data = request.json
+    # A JSON array or an NDJSON body is a batch (e.g. one kiosk cycle from a gateway)
+    if request.mimetype in NDJSON_MIMETYPES:
+        return _update_queue_batch([line for line in request.get_data(as_text=True).splitlines() if line.strip()])
+    data = request.get_json(silent=True)
+    if isinstance(data, list):
+        return _update_queue_batch(data)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object, a JSON array or NDJSON'}), 400
+    # Same checks (and optional timestamp) as each record of a batch
+    values, error = _validate_queue_record(data)
+    if error:
+        return jsonify({'error': error}), 400
     try:
-        # Basic validation
-        if not all(k in data for k in ('department', 'patients_waiting', 'active_doctors', 'avg_consultation_time')):
-            return jsonify({'error': 'Missing required fields'}), 400
-
-        new_entry = OPDQueue(
-            department=data['department'],
-            patients_waiting=data['patients_waiting'],
-            active_doctors=data['active_doctors'],
-            avg_consultation_time=data['avg_consultation_time']
-        )
+        new_entry = OPDQueue(**values)
         db.session.add(new_entry)
+        db.session.flush()
+        apply_increments([entry_increment(new_entry)])
+        apply_snapshot([entry_snapshot(new_entry)])
         db.session.commit()
+        forecast_cache.invalidate(new_entry.department)
+        forecaster.invalidate(new_entry.department)
         
-        # Trigger analysis
-        anomaly_detector.analyze_recent_data()
+        # Analysis runs on every update; retraining once enough new rows piled up
+        pipeline.submit('detect')
+        if model_registry.should_retrain(new_entry.id):
+            pipeline.submit('retrain')
+        event_broker.notify()
         
         return jsonify({'message': 'Queue data updated successfully', 'id': new_entry.id}), 201
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def _update_queue_batch(items):
+    if not items:
+        return jsonify({'error': 'Empty batch'}), 400
+    if len(items) > MAX_UPDATE_BATCH:
+        return jsonify({'error': f'At most {MAX_UPDATE_BATCH} records per request'}), 400
+    
+    # Validate everything before writing anything
+    results, valid = [], []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            try:
+                item = json.loads(item)
+            except ValueError as e:
+                results.append({'index': index, 'status': 'rejected', 'error': f'Invalid JSON: {e}'})
+                continue
+        values, error = _validate_queue_record(item)
+        if error:
+            results.append({'index': index, 'status': 'rejected', 'error': error})
+        else:
+            results.append({'index': index, 'status': 'created'})
+            valid.append((index, values))
+    
+    # ?atomic=1: all or nothing
+    if not valid or (request.args.get('atomic') == '1' and len(valid) < len(items)):
+        for r in results:
+            if r['status'] == 'created':
+                r['status'] = 'not_inserted'
+        return jsonify({'count': 0, 'rejected': len(items) - len(valid), 'results': results}), 400
+    
+    try:
+        entries = [OPDQueue(**values) for _, values in valid]
+        # One transaction: the rows plus the rollup and snapshot rows they touch
+        db.session.add_all(entries)
+        db.session.flush()
+        apply_increments(merge_increments([entry_increment(e) for e in entries]))
+        apply_snapshot(latest_snapshots([entry_snapshot(e) for e in entries]))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    for (index, _), entry in zip(valid, entries):
+        results[index]['id'] = entry.id
+    departments = sorted({e.department for e in entries})
+    for dept in departments:
+        forecast_cache.invalidate(dept)
+        forecaster.invalidate(dept)
+    
+    # One detector pass for the batch; it evaluates each touched department once
+    pipeline.submit('detect')
+    if model_registry.should_retrain(max(e.id for e in entries)):
+        pipeline.submit('retrain')
+    event_broker.notify()
+    
+    status = 201 if len(valid) == len(items) else 207
+    return jsonify({
+        'count': len(valid),
+        'rejected': len(items) - len(valid),
+        'departments': departments,
+        'results': results
+    }), status
+
+def _validate_queue_record(item):
+    """Returns (column values, None) or (None, error message) for one queue record."""
+    if not isinstance(item, dict):
+        return None, 'Record must be an object'
+    missing = [k for k in ('department', 'patients_waiting', 'active_doctors', 'avg_consultation_time') if k not in item]
+    if missing:
+        return None, f'Missing required fields: {missing}'
+    
+    department = item['department']
+    if not isinstance(department, str) or not department.strip() or len(department) > 50:
+        return None, 'department must be a non-empty string of at most 50 characters'
+    values = {'department': department.strip()}
+    for field, kind in (('patients_waiting', int), ('active_doctors', int), ('avg_consultation_time', float)):
+        value = item[field]
+        # bool is an int subclass; integral floats like 12.0 are fine for counts
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or \
+                (kind is int and value != int(value)) or value < 0:
+            return None, f'{field} must be a non-negative {"integer" if kind is int else "number"}'
+        values[field] = kind(value)
+    
+    if item.get('timestamp') is not None:
+        try:
+            timestamp = datetime.fromisoformat(str(item['timestamp']))
+        except ValueError:
+            return None, 'timestamp must be ISO 8601'
+        values['timestamp'] = _naive_utc(timestamp)
+    return values, None
+
+def _naive_utc(value):
+    # Timestamps are stored naive, in UTC like the column default
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+@api_bp.route('/pipeline/status', methods=['GET'])
+def get_pipeline_status():
+    return jsonify(pipeline.status())
+
+@api_bp.route('/queue/current', methods=['GET'])
+def get_current_queue():
+    # Latest state of every department, from the maintained snapshot
+    rows = OPDQueueCurrent.query.order_by(OPDQueueCurrent.department).all()
+    return jsonify([r.to_dict() for r in rows])
+
+@api_bp.route('/model/train', methods=['POST'])
+def train_model():
+    if not current_user.is_authenticated or current_user.role != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+    # Incremental by default; ?full=1 forces a refit on the whole history.
+    # Training runs in the background pipeline; poll /api/pipeline/status
+    full = request.args.get('full', '').lower() in ('1', 'true', 'yes')
+    job = pipeline.submit('retrain_full' if full else 'retrain')
+    return jsonify({
+        'job': job,
+        'full': full,
+        'model': model_registry.metadata()
+    }), 202
+
 @api_bp.route('/prediction/wait-time', methods=['GET'])
 def get_wait_time():
     dept = request.args.get('department')
@@ -100,62 +316,233 @@ def get_wait_time():
         return jsonify({'error': 'Department required'}), 400
     
     # Simple logic: get latest status of department to predict
-    latest = OPDQueue.query.filter_by(department=dept).order_by(OPDQueue.timestamp.desc()).first()
+    latest = db.session.get(OPDQueueCurrent, dept)
     
     if not latest:
         return jsonify({'message': 'No data for department', 'predicted_wait_time_minutes': 0}), 200
 
-    # Ensure model is trained (naively for demo)
-    if not predictor.is_trained:
-        predictor.train() # This fetches data from DB
-
-    predicted_minutes = predictor.predict(latest.patients_waiting, latest.active_doctors)
+    predicted_minutes = model_registry.current().predict(latest.patients_waiting, latest.active_doctors, department=dept)
     
-    # Crowd intensity
-    intensity = "Low"
-    if predicted_minutes > 60: intensity = "High congestion"
-    elif predicted_minutes > 30: intensity = "Medium"
-
     return jsonify({
         'department': dept,
         'predicted_wait_time_minutes': round(predicted_minutes, 1),
-        'crowd_intensity': intensity
+        'crowd_intensity': _crowd_intensity(predicted_minutes)
     })
 
+@api_bp.route('/prediction/wait-time/batch', methods=['POST'])
+def get_wait_time_batch():
+    # Accepts either a list of records or an object of equal-length arrays
+    data = request.get_json(silent=True)
+    fields = ('department', 'patients_waiting', 'active_doctors')
+    if isinstance(data, list):
+        data = {k: [item.get(k) if isinstance(item, dict) else None for item in data]
+                for k in fields + ('timestamp',)}
+    if not isinstance(data, dict) or not all(isinstance(data.get(k), list) for k in fields):
+        return jsonify({'error': f'Required arrays: {list(fields)}'}), 400
+    
+    size = len(data['department'])
+    timestamps = data.get('timestamp')
+    if any(len(data[k]) != size for k in fields) or (timestamps is not None and len(timestamps) != size):
+        return jsonify({'error': 'All arrays must have the same length'}), 400
+    if size > MAX_BATCH_PREDICTIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_PREDICTIONS} predictions per request'}), 400
+    
+    # Same department rule as queue records, and only departments with data
+    departments = data['department']
+    invalid = [i for i, d in enumerate(departments) if not isinstance(d, str) or not d.strip() or len(d) > 50]
+    if invalid:
+        return jsonify({'error': 'department must be a non-empty string of at most 50 characters',
+                        'indexes': invalid[:100]}), 400
+    departments = [d.strip() for d in departments]
+    known = set(db.session.scalars(db.select(OPDQueueCurrent.department)))
+    unknown = sorted(set(departments) - known)
+    if unknown:
+        return jsonify({'error': f'Unknown department(s): {unknown[:20]}'}), 400
+    
+    import numpy as np
+    try:
+        patients = np.asarray(data['patients_waiting'], dtype=np.float64)
+        doctors = np.asarray(data['active_doctors'], dtype=np.float64)
+        # Missing timestamps mean "now"
+        now = np.datetime64(datetime.now(), 'm')
+        when = np.full(size, now) if timestamps is None else \
+            np.array([now if t is None else t for t in timestamps], dtype='datetime64[m]')
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid input: {e}'}), 400
+    if not (np.isfinite(patients).all() and np.isfinite(doctors).all()) or (patients < 0).any() or (doctors < 0).any():
+        return jsonify({'error': 'patients_waiting and active_doctors must be non-negative numbers'}), 400
+    
+    predicted = model_registry.current().predict_batch(patients, doctors, when, departments)
+    
+    return jsonify({
+        'count': size,
+        'predictions': [
+            {
+                'department': dept,
+                'timestamp': ts.isoformat(),
+                'predicted_wait_time_minutes': round(minutes, 1),
+                'crowd_intensity': _crowd_intensity(minutes)
+            }
+            for dept, ts, minutes in zip(departments, when.tolist(), predicted.tolist())
+        ]
+    })
+
+def _crowd_intensity(minutes):
+    if minutes > 60: return "High congestion"
+    if minutes > 30: return "Medium"
+    return "Low"
+
 @api_bp.route('/alerts', methods=['GET'])
 def get_alerts():
-    # Fetch unresolved alerts
-    alerts = SilentIssue.query.filter_by(is_resolved=False).order_by(SilentIssue.timestamp.desc()).all()
-    return jsonify([a.to_dict() for a in alerts])
+    # Unresolved alerts, newest first, one page at a time. The body stays a
+    # plain list; the next page's cursor is in the Link / X-Next-Cursor headers.
+    limit = min(max(request.args.get('limit', DEFAULT_ALERT_PAGE, type=int), 1), MAX_ALERT_PAGE)
+    cursor = request.args.get('cursor')
+    # "= false" rather than "IS false", which PostgreSQL can't match to ix_sc_silent_issues_feed
+    unresolved = SilentIssue.query.filter(SilentIssue.is_resolved == false())
+    
+    # Cheap fingerprint of the unresolved set (index-only aggregate); unchanged means 304
+    count, max_id, max_ts = unresolved.with_entities(
+        func.count(SilentIssue.id), func.max(SilentIssue.id), func.max(SilentIssue.timestamp)
+    ).one()
+    etag = f'alerts-{count}-{max_id}-{max_ts.isoformat() if max_ts else ""}-{limit}-{cursor or ""}'
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    query = unresolved
+    if cursor:
+        try:
+            cursor_ts, cursor_id = cursor.rsplit('_', 1)
+            cursor_ts, cursor_id = datetime.fromisoformat(cursor_ts), int(cursor_id)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        # Keyset pagination on (timestamp, id): stable while new alerts arrive
+        query = query.filter(or_(
+            SilentIssue.timestamp < cursor_ts,
+            and_(SilentIssue.timestamp == cursor_ts, SilentIssue.id < cursor_id)
+        ))
+    alerts = query.order_by(SilentIssue.timestamp.desc(), SilentIssue.id.desc()).limit(limit + 1).all()
+    
+    response = jsonify([a.to_dict() for a in alerts[:limit]])
+    if len(alerts) > limit:
+        last = alerts[limit - 1]
+        next_cursor = f'{last.timestamp.isoformat()}_{last.id}'
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{url_for("api.get_alerts", limit=limit, cursor=next_cursor)}>; rel="next"'
+    response.set_etag(etag)
+    # Browsers revalidate with If-None-Match on every poll
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @api_bp.route('/analytics/forecast', methods=['GET'])
 def get_forecast():
     dept = request.args.get('department', 'General')
-    # Train if needed
-    if not predictor.is_trained:
-        predictor.train() # In prod, load pre-trained
-    
-    forecasts = predictor.predict_future_slots(dept, hours=12)
+    predictor = model_registry.current()
+    # Recomputed only when the model version, the hour or the department's data changes
+    forecasts = forecast_cache.get_or_compute(
+        dept, model_registry.version, 12,
+        lambda hour_start: predictor.predict_future_slots(dept, hours=12, start=hour_start)
+    )
     return jsonify(forecasts)
 
+@api_bp.route('/events/stream', methods=['GET'])
+def stream_events():
+    # Server-sent events: 'queue', 'alert' and 'forecast' pushes, replacing polling
+    departments = [d for d in request.args.get('departments', 'General').split(',') if d]
+    subscriber = event_broker.subscribe(departments)
+    if subscriber is None:
+        # Out of stream slots in this worker: the dashboard falls back to polling
+        response = jsonify({'error': 'Too many open event streams', 'poll_seconds': 30})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    heartbeat = current_app.config['EVENTS_HEARTBEAT_SECONDS']
+    max_seconds = current_app.config['EVENTS_MAX_STREAM_SECONDS']
+    
+    def generate():
+        try:
+            yield from subscriber.stream(heartbeat, max_seconds)
+        finally:
+            event_broker.unsubscribe(subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@api_bp.route('/analytics/history', methods=['GET'])
+def get_history():
+    # Queue history across the retention cutoff: archived summaries plus raw rows
+    import pandas as pd
+    from app.retention import daily_history, hourly_history
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in HISTORY_RANGE_DAYS:
+        return jsonify({'error': 'resolution must be hour or day'}), 400
+    default_days, max_days = HISTORY_RANGE_DAYS[resolution]
+    try:
+        end = _naive_utc(datetime.fromisoformat(request.args['end'])) if request.args.get('end') \
+            else datetime.utcnow()
+        start = (_naive_utc(datetime.fromisoformat(request.args['start'])) if request.args.get('start')
+                 else end - timedelta(days=default_days))
+    except ValueError:
+        return jsonify({'error': 'start and end must be ISO dates'}), 400
+    if start >= end:
+        return jsonify({'error': 'start must be before end'}), 400
+    if end - start > timedelta(days=max_days):
+        return jsonify({'error': f'At most {max_days} days at {resolution} resolution'}), 400
+    
+    reader = hourly_history if resolution == 'hour' else daily_history
+    df = reader(request.args.get('department') or None, start, end).sort_values(['bucket_start', 'department'])
+    count = df['count'].to_numpy(dtype=float)
+    return jsonify({
+        'resolution': resolution,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'buckets': [
+            {
+                'department': department,
+                'bucket_start': bucket_start.isoformat(),
+                'count': int(n),
+                'mean_patients_waiting': round(patients / n, 2),
+                'max_patients_waiting': int(peak),
+                'mean_active_doctors': round(doctors / n, 2),
+                'mean_consultation_time': round(consultation / n, 2),
+            }
+            for department, bucket_start, n, patients, peak, doctors, consultation in zip(
+                df['department'].tolist(), pd.to_datetime(df['bucket_start']).tolist(), count.tolist(),
+                df['sum_patients_waiting'].tolist(), df['max_patients_waiting'].tolist(),
+                df['sum_active_doctors'].tolist(), df['sum_consultation_time'].tolist()
+            )
+        ]
+    })
+
 @api_bp.route('/analytics/heatmap', methods=['GET'])
 def get_heatmap():
-    # Mock aggregation for heatmap (Day vs Hour)
-    # In real world: SQL Group By query
+    # Day vs Hour intensity, read from the maintained hourly rollup
+    dept = request.args.get('department')
     days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-    heatmap_data = []
+    hours = range(9, 18) # 9 AM to 5 PM
+    
+    query = OPDQueueHourlyRollup.query.filter(OPDQueueHourlyRollup.hour.between(hours.start, hours.stop - 1))
+    if dept:
+        query = query.filter_by(department=dept)
     
+    # Combine departments per slot: (count, sum of patients waiting)
+    slots = {}
+    for r in query.all():
+        count, total = slots.get((r.day_of_week, r.hour), (0, 0.0))
+        slots[(r.day_of_week, r.hour)] = (count + r.count, total + r.sum_patients_waiting)
+    means = {slot: total / count for slot, (count, total) in slots.items() if count}
+    peak = max(means.values(), default=0)
+    
+    heatmap_data = []
     for day_idx, day_name in enumerate(days):
         day_row = {'name': day_name, 'data': []}
-        for hour in range(9, 18): # 9 AM to 5 PM
-            # Simulated "intensity" score 0-100
-            intensity = 20 # Base
-            if day_idx < 5: # Weekday
-                if 10 <= hour <= 12: intensity = 85 # Peak
-                elif 14 <= hour <= 16: intensity = 60
-            else: # Weekend
-                intensity = 40
-                
+        for hour in hours:
+            # "intensity" score 0-100, relative to the busiest slot
+            intensity = round(100 * means.get((day_idx, hour), 0) / peak) if peak else 0
             day_row['data'].append({
                 'x': f"{hour}:00",
                 'y': intensity
@@ -81,15 +81,30 @@ def dashboard():
 @login_required
 def patient_dashboard():
     # Pass department stats directly to template
-    from app.models import OPDQueue
-    from app.ml.predictor import WaitingDurationPredictor
-    predictor = WaitingDurationPredictor()
+    from app import model_registry
+    from app.models import OPDQueueCurrent
     
     depts_list = ['General', 'Ortho', 'ENT', 'Cardiology', 'Pediatrics']
+    # One read of the current-state snapshot for every department
+    latest_by_dept = {
+        r.department: r
+        for r in OPDQueueCurrent.query.filter(OPDQueueCurrent.department.in_(depts_list))
+    }
+    
+    # One model call for every department (per shard when sharded), using the shared trained model
+    waits = {}
+    if latest_by_dept:
+        predicted = model_registry.current().predict_batch(
+            [r.patients_waiting for r in latest_by_dept.values()],
+            [r.active_doctors for r in latest_by_dept.values()],
+            departments=list(latest_by_dept.keys())
+        )
+        waits = dict(zip(latest_by_dept.keys(), predicted))
+    
     departments_data = []
     
     for d_name in depts_list:
-        latest = OPDQueue.query.filter_by(department=d_name).order_by(OPDQueue.timestamp.desc()).first()
+        latest = latest_by_dept.get(d_name)
         
         dept_info = {
             'name': d_name,
@@ -106,10 +121,7 @@ def patient_dashboard():
             dept_info['active_doctors'] = latest.active_doctors
             dept_info['avg_time'] = latest.avg_consultation_time
             
-            # Predict
-            # Predict
-            if not predictor.is_trained: predictor.train()
-            wait = predictor.predict(latest.patients_waiting, latest.active_doctors)
+            wait = float(waits[d_name])
             
             # Convert to Hours/Minutes string
             wait_min = int(round(wait))
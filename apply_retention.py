@@ -0,0 +1,19 @@
+import argparse
+from app import create_app
+from app.retention import RetentionManager
+
+parser = argparse.ArgumentParser(description='Archive and downsample queue rows older than RETENTION_RAW_DAYS.')
+parser.add_argument('--max-days', type=int, default=None, help='Stop after this many days (default: catch up fully)')
+args = parser.parse_args()
+
+app = create_app()
+
+with app.app_context():
+
+    # Safe to run repeatedly (e.g. nightly); each processed day commits on its own
+    manager = RetentionManager.from_config(app.config)
+    report = manager.run(max_days=args.max_days)
+    
+    for day in report['days']:
+        print(f"{day['day']}: archived {day['rows']} rows to {day['archive']}")
+    print(f"Retention complete: {len(report['days'])} day(s) processed, raw data kept from {report['cutoff']}.")
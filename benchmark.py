@@ -0,0 +1,357 @@
+"""Benchmarks the API and ML hot paths against synthetic queue histories.
+
+For each history size a SQLite database is seeded (and kept for re-runs)
+under --data-dir and a model is trained on it. Each run works on a fresh
+copy of that database, so the update and upload scenarios never grow the
+seeded history, and every scenario is driven through Flask's test client by
+--threads concurrent clients; scenarios that write run after the read-only
+ones. Results go to
+stdout or --output as JSON: throughput, latency percentiles and peak memory
+per (rows, scenario). Pass --compare with an earlier result file to fail on
+p95 regressions.
+
+    python benchmark.py --rows 10000 100000 --requests 200 --threads 8 --output bench.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+SCENARIOS = ['wait_time', 'wait_time_batch', 'forecast', 'heatmap', 'alerts', 'update', 'update_batch', 'upload',
+             'patient_dashboard', 'analyze']
+DEPARTMENTS = ['General', 'Ortho', 'ENT', 'Cardiology', 'Pediatrics']
+BENCH_USER = ('bench-patient', 'bench-password')
+# Run after the read-only scenarios, whatever order they were given in
+WRITE_SCENARIOS = ('update', 'update_batch', 'upload')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000], help='history sizes to seed (10k-10M)')
+    parser.add_argument('--days', type=int, default=365, help='days of history the rows are spread over')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--threads', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--upload-rows', type=int, default=500, help='rows per CSV in the upload scenario')
+    parser.add_argument('--data-dir', default=os.path.join('instance', 'benchmark'))
+    parser.add_argument('--reseed', action='store_true', help='rebuild databases even if they exist')
+    parser.add_argument('--no-train', action='store_true', help='benchmark the untrained fallback model')
+    parser.add_argument('--tracemalloc', action='store_true', help='also report peak Python heap per scenario (slower)')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    parser.add_argument('--compare', help='earlier result file to compare p95 latency against')
+    parser.add_argument('--max-regression', type=float, default=0.25, help='allowed p95 slowdown (0.25 = 25%%)')
+    return parser.parse_args()
+
+
+def database_path(args, rows, working=False):
+    name = f'queue-{rows}.run.db' if working else f'queue-{rows}.db'
+    return os.path.abspath(os.path.join(args.data_dir, name))
+
+
+def configure(args, rows, working=False):
+    # Must happen before the app is imported: config is read from the environment
+    os.makedirs(args.data_dir, exist_ok=True)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database_path(args, rows, working)
+    os.environ['MODEL_DIR'] = os.path.abspath(os.path.join(args.data_dir, f'models-{rows}'))
+    os.environ['UPLOAD_SPOOL_DIR'] = os.path.abspath(os.path.join(args.data_dir, 'uploads'))
+    os.environ['FORECAST_CACHE_BACKEND'] = 'memory'
+    # Measure the request path only; retraining is benchmarked separately
+    os.environ['PIPELINE_RETRAIN_DELAY'] = '86400'
+
+
+def seed(app, args, rows):
+    import numpy as np
+    import pandas as pd
+    from app import db, model_registry
+    from app.ingest import BulkQueueIngestor
+    from app.models import OPDQueue, User
+
+    with app.app_context():
+        if args.reseed:
+            db.drop_all()
+        db.create_all()
+        if not User.query.filter_by(username=BENCH_USER[0]).first():
+            user = User(username=BENCH_USER[0], role='patient')
+            user.set_password(BENCH_USER[1])
+            db.session.add(user)
+            db.session.commit()
+
+        existing = db.session.query(db.func.count(OPDQueue.id)).scalar()
+        if existing >= rows:
+            if not args.no_train and model_registry.latest_version() is None:
+                model_registry.retrain(full=True)
+            db.engine.dispose()
+            return {'seeded': False, 'rows': existing}
+
+        start = time.perf_counter()
+        rng = np.random.default_rng(42)
+        ingestor = BulkQueueIngestor(chunk_size=50000)
+        end = datetime.now().replace(second=0, microsecond=0)
+        step = timedelta(days=args.days) / rows
+        for offset in range(existing, rows, 200000):
+            n = min(200000, rows - offset)
+            index = np.arange(offset, offset + n)
+            when = pd.Timestamp(end - timedelta(days=args.days)) + pd.to_timedelta(index * step.total_seconds(), unit='s').floor('s')
+            # Busier mornings, with noise
+            load = 10 + 15 * np.exp(-((when.hour.to_numpy() - 11) ** 2) / 8)
+            ingestor.ingest(pd.DataFrame({
+                'timestamp': when,
+                'department': np.array(DEPARTMENTS)[index % len(DEPARTMENTS)],
+                'patients_waiting': rng.poisson(load),
+                'active_doctors': rng.integers(1, 6, n),
+                'avg_consultation_time': rng.uniform(5, 20, n).round(1),
+            }), row_offset=offset)
+
+        seed_seconds = time.perf_counter() - start
+        train_seconds = None
+        if not args.no_train:
+            start = time.perf_counter()
+            model_registry.retrain(full=True)
+            train_seconds = time.perf_counter() - start
+        # Close the file before run_size() copies it
+        db.engine.dispose()
+        return {'seeded': True, 'rows': rows, 'seed_seconds': round(seed_seconds, 2),
+                'train_seconds': round(train_seconds, 2) if train_seconds is not None else None}
+
+
+def make_request(scenario, args):
+    """Returns a function(client, i) issuing one request of the scenario."""
+    import numpy as np
+
+    def department(i):
+        return DEPARTMENTS[i % len(DEPARTMENTS)]
+
+    if scenario == 'wait_time':
+        return lambda client, i: client.get(f'/api/prediction/wait-time?department={department(i)}')
+    if scenario == 'wait_time_batch':
+        body = [{'department': department(i), 'patients_waiting': i % 40, 'active_doctors': 1 + i % 5} for i in range(100)]
+        return lambda client, i: client.post('/api/prediction/wait-time/batch', json=body)
+    if scenario == 'forecast':
+        return lambda client, i: client.get(f'/api/analytics/forecast?department={department(i)}')
+    if scenario == 'heatmap':
+        return lambda client, i: client.get('/api/analytics/heatmap')
+    if scenario == 'alerts':
+        return lambda client, i: client.get('/api/alerts')
+    if scenario == 'update':
+        return lambda client, i: client.post('/api/queue/update', json={
+            'department': department(i), 'patients_waiting': i % 40, 'active_doctors': 1 + i % 5,
+            'avg_consultation_time': 10.0
+        })
+    if scenario == 'update_batch':
+        # One refresh cycle of 40 kiosks spread over the seeded departments
+        body = [{'department': department(j), 'patients_waiting': j % 40, 'active_doctors': 1 + j % 5,
+                 'avg_consultation_time': 10.0} for j in range(40)]
+        return lambda client, i: client.post('/api/queue/update', json=body)
+    if scenario == 'upload':
+        rng = np.random.default_rng(7)
+        now = datetime.now()
+        lines = ['timestamp,department,patients_waiting,active_doctors,avg_consultation_time']
+        for j in range(args.upload_rows):
+            lines.append(f'{now - timedelta(minutes=j):%Y-%m-%d %H:%M:%S},{department(j)},'
+                         f'{rng.integers(0, 40)},{rng.integers(1, 6)},{rng.uniform(5, 20):.1f}')
+        csv = '\n'.join(lines).encode()
+        return lambda client, i: client.post('/api/queue/upload', data={'file': (io.BytesIO(csv), 'bench.csv')},
+                                             content_type='multipart/form-data')
+    if scenario == 'patient_dashboard':
+        return lambda client, i: client.get('/patient-dashboard')
+    raise ValueError(scenario)
+
+
+def run_scenario(app, scenario, args):
+    if args.tracemalloc:
+        tracemalloc.start()
+    if scenario == 'analyze':
+        # Not an endpoint: the full resync the 'rescan' pipeline task runs
+        # after uploads, from a cold detector each time
+        from app.ml.anomaly import StreamingIssueDetector
+        requests, threads = max(1, args.requests // 20), 1
+
+        def issue(client, i):
+            with app.app_context():
+                StreamingIssueDetector().analyze_recent_data()
+    else:
+        requests, threads = args.requests, args.threads
+        issue = make_request(scenario, args)
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        client = app.test_client()
+        if scenario == 'patient_dashboard':
+            client.post('/login', data={'username': BENCH_USER[0], 'password': BENCH_USER[1]})
+        own_latencies, own_errors = [], []
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            start = time.perf_counter()
+            try:
+                response = issue(client, i)
+                if response is not None and response.status_code >= 400:
+                    own_errors.append(response.status_code)
+            except Exception as e:
+                own_errors.append(repr(e))
+            own_latencies.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own_latencies)
+            errors.extend(own_errors)
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    import numpy as np
+    ms = np.array(latencies) * 1000
+    result = {
+        'scenario': scenario,
+        'requests': requests,
+        'threads': threads,
+        'errors': len(errors),
+        'error_samples': [str(e) for e in errors[:5]],
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(float(ms.mean()), 3),
+            'p50': round(float(np.percentile(ms, 50)), 3),
+            'p95': round(float(np.percentile(ms, 95)), 3),
+            'p99': round(float(np.percentile(ms, 99)), 3),
+            'max': round(float(ms.max()), 3),
+        },
+        # ru_maxrss is the process high-water mark (KiB on Linux)
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if args.tracemalloc:
+        result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        tracemalloc.stop()
+    return result
+
+
+def run_size(args, rows):
+    """One history size: seed, then benchmark a copy of the seeded database.
+
+    Both steps run in a fresh interpreter so config and memory start clean.
+    """
+    command = [sys.executable, __file__, '--_seed', str(rows)] + sys.argv[1:]
+    dataset = json.loads(subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout)
+    working = database_path(args, rows, working=True)
+    for suffix in ('-wal', '-shm', '-journal'):
+        if os.path.exists(working + suffix):
+            os.remove(working + suffix)
+    shutil.copyfile(database_path(args, rows), working)
+    try:
+        command = [sys.executable, __file__, '--_child', str(rows)] + sys.argv[1:]
+        output = json.loads(subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout)
+    finally:
+        os.remove(working)
+    return dict(output, dataset=dataset)
+
+
+def seed_child(args, rows):
+    configure(args, rows)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import create_app
+    json.dump(seed(create_app(), args, rows), sys.stdout)
+
+
+def child(args, rows):
+    configure(args, rows, working=True)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import create_app
+    app = create_app()
+    results = []
+    scenarios = ([s for s in args.scenarios if s not in WRITE_SCENARIOS]
+                 + [s for s in args.scenarios if s in WRITE_SCENARIOS])
+    for scenario in scenarios:
+        result = run_scenario(app, scenario, args)
+        results.append(dict(result, rows=rows))
+        print(f"{rows:>10} {scenario:<18} {result['throughput_rps']:>9} rps  "
+              f"p50 {result['latency_ms']['p50']:>9} ms  p95 {result['latency_ms']['p95']:>9} ms  "
+              f"p99 {result['latency_ms']['p99']:>9} ms  errors {result['errors']}", file=sys.stderr)
+    json.dump({'results': results}, sys.stdout)
+
+
+def compare(report, baseline_path, max_regression):
+    with open(baseline_path) as f:
+        baseline = {(r['rows'], r['scenario']): r for r in json.load(f)['results']}
+    regressions = []
+    for result in report['results']:
+        before = baseline.get((result['rows'], result['scenario']))
+        if before is None or not before['latency_ms']['p95']:
+            continue
+        change = result['latency_ms']['p95'] / before['latency_ms']['p95'] - 1
+        if change > max_regression:
+            regressions.append({'rows': result['rows'], 'scenario': result['scenario'],
+                                'p95_before': before['latency_ms']['p95'],
+                                'p95_after': result['latency_ms']['p95'], 'change': round(change, 3)})
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    for flag, step in (('--_seed', seed_child), ('--_child', child)):
+        if flag in sys.argv:
+            position = sys.argv.index(flag)
+            rows = int(sys.argv[position + 1])
+            del sys.argv[position:position + 2]
+            step(parse_args(), rows)
+            return 0
+
+    args = parse_args()
+    report = {
+        'meta': {
+            'started_at': datetime.now().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        },
+        'datasets': [],
+        'results': [],
+    }
+    for rows in args.rows:
+        size = run_size(args, rows)
+        report['datasets'].append(size['dataset'])
+        report['results'].extend(size['results'])
+
+    status = 0
+    if args.compare:
+        report['regressions'] = compare(report, args.compare, args.max_regression)
+        status = 1 if report['regressions'] else 0
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    for r in report.get('regressions', []):
+        print(f"REGRESSION {r['rows']} {r['scenario']}: p95 {r['p95_before']} -> {r['p95_after']} ms", file=sys.stderr)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,3 +5,5 @@ set -o errexit
 pip install -r requirements.txt
 
 python init_db.py
+
+python train_model.py
@@ -0,0 +1,19 @@
+import os
+
+# Threaded workers, so long-lived /api/events/stream connections each hold a
+# thread rather than a whole worker process
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+# Load the app once in the master so workers share its memory (and the
+# loaded model) copy-on-write
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+
+def post_fork(server, worker):
+    # A preloaded app's connection pool was created in the master; each
+    # worker must start with its own
+    if preload_app:
+        from run import app
+        from app import dispose_db_pools
+        dispose_db_pools(app)
@@ -1,7 +1,9 @@
 
 import os
+from sqlalchemy import inspect, text
 from app import create_app, db
-from app.models import OPDQueue, SilentIssue, User
+from app.models import OPDQueue, OPDQueueCurrent, OPDQueueHourlyHistory, OPDQueueHourlyRollup, SilentIssue, User
+from app.rollups import rebuild_current_snapshot, rebuild_rollups
 
 app = create_app()
 
@@ -10,6 +12,26 @@ with app.app_context():
     # Create tables if they don't exist
     db.create_all()
     
+    # Columns added since the table was first created
+    existing = {c['name'] for c in inspect(db.engine).get_columns('sc_silent_issues')}
+    if 'department' not in existing:
+        with db.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE sc_silent_issues ADD COLUMN department VARCHAR(50)'))
+        print("Added sc_silent_issues.department.")
+    
+    # create_all() skips indexes on tables that already exist
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    
+    # Seed the current-state snapshot when upgrading an existing database
+    if not OPDQueueCurrent.query.first() and OPDQueue.query.first():
+        print(f"Built current-state snapshot for {rebuild_current_snapshot()} departments.")
+    
+    # Same for the hourly rollup behind the heatmap and forecast baselines
+    if not OPDQueueHourlyRollup.query.first() and (OPDQueue.query.first() or OPDQueueHourlyHistory.query.first()):
+        print(f"Built hourly rollup from {rebuild_rollups()} queue records.")
+    
     # Create Admin User if not exists
     admin_user = User.query.filter_by(username='admin').first()
     if not admin_user:
@@ -0,0 +1,14 @@
+from app import create_app
+from app.rollups import rebuild_current_snapshot, rebuild_rollups
+
+app = create_app()
+
+with app.app_context():
+
+    # Recompute the hourly heatmap rollup from the full queue history (run after backfills)
+    rows = rebuild_rollups()
+    print(f"Rebuilt hourly rollup from {rows} queue records.")
+
+    # Latest state per department (patient dashboard, /api/queue/current)
+    departments = rebuild_current_snapshot()
+    print(f"Rebuilt current-state snapshot for {departments} departments.")
@@ -0,0 +1,50 @@
+import argparse
+import json
+from app import create_app
+from app.ml.replay import AnomalyReplay, default_rules
+
+
+def rule_setting(text):
+    defaults = default_rules()
+    name, _, value = text.partition('=')
+    if name not in defaults:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE with NAME one of: {', '.join(defaults)}")
+    try:
+        # Same type as the default: window=40, surge_z=3.5
+        return name, type(defaults[name])(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{name} takes a {type(defaults[name]).__name__}, not {value!r}')
+
+
+# Guarded so the processes of the replay pool can import this module
+# without re-running it
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay the silent-issue rules over the queue history and report the alerts they would have raised.')
+    parser.add_argument('--set', dest='rules', type=rule_setting, action='append', default=[], metavar='NAME=VALUE',
+                        help='override a rule setting, e.g. --set surge_z=3 (repeatable)')
+    parser.add_argument('--department', dest='departments', action='append', help='only replay this department (repeatable)')
+    parser.add_argument('--processes', type=int, default=1, help='evaluate chunks in this many processes')
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--alerts', type=int, default=20, help='how many of the alerts to list (-1 = all)')
+    parser.add_argument('--output', help='write the full report, with every alert, as JSON to this file')
+    args = parser.parse_args()
+
+    app = create_app()
+
+    with app.app_context():
+
+        # Read-only: nothing is written to sc_silent_issues
+        report = AnomalyReplay(args.chunk_size, args.processes, **dict(args.rules)).run(args.departments)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        shown = report['alerts'] if args.alerts < 0 else report['alerts'][:args.alerts]
+        for alert in shown:
+            print(f"{alert['timestamp']}  {alert['severity']:<6}  {alert['issue_type']:<21}  {alert['description']}")
+        timing = report['timing']
+        print(f"Replayed {report['rows']} queue records from {len(report['departments'])} departments "
+              f"in {timing['total_seconds']:.2f} s ({timing['rows_per_second']} records/s).")
+        print('Alerts that would have been raised: ' + ', '.join(f'{t}: {n}' for t, n in report['counts'].items()))
+        print('Rules: ' + ', '.join(f'{name}={value}' for name, value in report['rules'].items()))
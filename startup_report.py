@@ -0,0 +1,55 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Runs in a fresh interpreter so nothing is imported yet
+CHILD = '''
+import json, time
+started = time.perf_counter()
+from app import create_app
+app = create_app()
+report = dict(app.extensions['startup'], total_seconds=round(time.perf_counter() - started, 4))
+print(json.dumps(report))
+'''
+
+
+def measure(fast_start, top):
+    env = dict(os.environ, FAST_START='1' if fast_start else '0')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD],
+        env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+
+    # "import time: self [us] | cumulative | imported package"; top-level
+    # imports are the ones without leading spaces in the name column
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name[1:].startswith(' '):
+            imports.append((int(cumulative), name.strip()))
+    imports.sort(reverse=True)
+    report['import_seconds'] = round(sum(us for us, _ in imports) / 1e6, 4)
+    report['slowest_imports'] = [{'module': name, 'ms': round(us / 1000, 1)} for us, name in imports[:top]]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Start-up time and import-time report for create_app().')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest top-level imports to list')
+    args = parser.parse_args()
+
+    reports = {
+        'default': measure(False, args.top),
+        'fast_start': measure(True, args.top),
+    }
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+import sys
+from app import create_app, model_registry
+from app.ml.registry import NOT_TRAINED_EXIT
+
+# Guarded so the processes of a sharded (MODEL_SHARDING=1) training pool
+# can import this module without re-running it
+if __name__ == '__main__':
+    app = create_app()
+
+    with app.app_context():
+
+        # Full refit on the whole history; pass --incremental to only fold in new rows
+        full = '--incremental' not in sys.argv
+        
+        # Always train here; with MODEL_COMPACT web workers call this script
+        if model_registry.retrain(full=full, in_process=True):
+            meta = model_registry.metadata()
+            print(f"Published model v{meta['version']} (trained on {meta['trained_rows']} rows, up to id {meta['last_trained_id']}).")
+            if 'compact' in meta:
+                report = meta['compact']
+                print(f"Compact serving model: {report['nodes']} of {report['sklearn_nodes']} nodes, "
+                      f"{report['bytes'] / 2**20:.1f} MB instead of {report['sklearn_bytes'] / 2**20:.1f} MB, "
+                      f"mean abs error {report['mean_abs_error']:.3f} min (max {report['max_abs_error']:.3f}), "
+                      f"{report['row_ms']:.2f} ms per prediction instead of {report['sklearn_row_ms']:.2f} ms.")
+        else:
+            print("No queue data available; model not trained.")
+            # Only the registry's child process wants a distinct status; deploys exit 0
+            if '--report-untrained' in sys.argv:
+                sys.exit(NOT_TRAINED_EXIT)